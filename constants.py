@@ -0,0 +1,24 @@
+# (C) 2019 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+# Physical constants shared by the models
+#
+# The values are the same as scipy.constants, but importing scipy takes longer
+# than running the graders' cases, so this module has no dependencies.
+
+sigma   = 5.6703744191844314e-08   # Stefan-Boltzmann constant, W/(m*m*K**4)
+calorie = 4.184                    # J (thermochemical calorie)
+gram    = 0.001                    # Kg
+year    = 31536000.0               # seconds in a year of 365 days
@@ -19,12 +19,11 @@
 # The goal is to numerically simulate how the planetary temperature of a naked planet would
 # change through time as it approaches equilibrium (the state at which it stops changing, 
 # which we calculated before). The planet starts with some initial temperature. 
-# The heat capacity (units of Joules / m2 K) of the planet is set by a layer of 
+# The “heat capacity” (units of Joules / m2 K) of the planet is set by a layer of 
 # water which absorbs heat and changes its temperature. If the layer is very thick, 
 # it takes a lot more heat (Joules) to change the temperature.
 
-import sys, getopt, re, os
-from scipy import constants
+import sys, getopt, re, os, itertools, constants
 
 
 # Other constants
@@ -70,6 +69,180 @@ def iterate_naked_planet(number_of_steps,must_plot,name,y_time_step,water_depth)
     
   return (temperature_list[-1],heat_flux_out_calc(temperature_list[-1]))
 
+# Alternatives to iterate_naked_planet
+#
+# The model is dT/dt = (L*(1-albedo)/4 - epsilon*sigma*T**4)/C, where C is the
+# heat capacity. Forward Euler oscillates, or diverges, if the step is large
+# compared to the relaxation time, and needs many steps if it is small, so
+# these functions calculate the temperature after a number of years directly.
+# Each takes years, water_depth, and initial_temperature, which may be arrays,
+# and returns (T,heat flux out) for each element, as iterate_naked_planet.
+
+def get_heat_capacity(water_depth):
+  return water_depth * Density_water * constants.calorie /constants.gram
+
+def get_equilibrium_temperature():
+  return (L * (1 - albedo) /(4 * epsilon * constants.sigma))**0.25
+
+# get_temperature_derivative
+#
+# dT/dt in degrees per second
+
+def get_temperature_derivative(T,heat_capacity):
+  return (L * (1 - albedo) /4 - heat_flux_out_calc(T))/heat_capacity
+
+# solve_naked_planet
+#
+# Analytic solution. With u = T/T_eq, du/dt = k*(1-u**4), where k=epsilon*sigma*T_eq**3/C,
+# which integrates to
+#     g(u) = g(u0) + 4*k*t,  where g(u) = log|(1+u)/(1-u)| + 2*atan(u)
+# We solve this for u by Newton's method, in terms of v = log|(1+u)/(1-u)|,
+# i.e. u = tanh(v/2) below equilibrium, or coth(v/2) above, so that
+#     dg/dv = 1 + 1/cosh(v) (below) or 1 - 1/cosh(v) (above)
+# which is well conditioned, even close to equilibrium.
+
+def solve_naked_planet(years,water_depth,initial_temperature=0,tolerance=1.0e-14,max_iterations=50):
+  import numpy
+  T_eq   = get_equilibrium_temperature()
+  rate   = 4 * epsilon * constants.sigma * T_eq**3 / get_heat_capacity(water_depth)
+  tau,u  = numpy.broadcast_arrays(rate * numpy.asarray(years,dtype=float) * constants.year,
+                                  numpy.asarray(initial_temperature,dtype=float) / T_eq)
+  u      = u.copy()
+  moving = (tau > 0) & (u != 1)             # others are at equilibrium, or have no time
+  tau    = tau[moving]
+  below  = u[moving] < 1
+  sign   = numpy.where(below,1.0,-1.0)
+
+  def get_u(v):
+    with numpy.errstate(divide='ignore'):
+      return numpy.where(below,numpy.tanh(v/2),1/numpy.tanh(v/2))
+
+  def g(v):
+    return v + 2*numpy.arctan(get_u(v))
+
+  with numpy.errstate(divide='ignore',over='ignore'):
+    v0     = 2*numpy.arctanh(numpy.where(below,u[moving],1/u[moving]))
+    target = g(v0) + tau
+    v      = v0 + tau
+    for i in range(max_iterations):
+      dv = (target - g(v)) / (1 + sign/numpy.cosh(v))
+      v  = numpy.maximum(v + dv,0)
+      if numpy.all(abs(dv) <= tolerance*numpy.maximum(1,v)):
+        break
+    else:
+      raise RuntimeError('Newton did not converge in {0} iterations'.format(max_iterations))
+  u[moving] = get_u(v)
+  T         = T_eq * u
+  return (T,heat_flux_out_calc(T))
+
+# integrate_naked_planet
+#
+# Adaptive integration, using the Dormand-Prince embedded Runge-Kutta 5(4)
+# pair. Each element has its own step, which is accepted if the difference
+# between the 5th and 4th order estimates is within atol + rtol*|T|, and
+# then adjusted to keep the error near the tolerance.
+#
+# An explicit method can't take steps much longer than the relaxation time,
+# however accurate, so an element that is within tolerance of equilibrium is
+# set to equilibrium and finished, since the solution only gets closer.
+
+DORMAND_PRINCE_A = [[],
+                    [1/5],
+                    [3/40, 9/40],
+                    [44/45, -56/15, 32/9],
+                    [19372/6561, -25360/2187, 64448/6561, -212/729],
+                    [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+                    [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]]
+DORMAND_PRINCE_E = [71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40]   # 5th - 4th order
+
+def integrate_naked_planet(years,water_depth,initial_temperature=0,rtol=1.0e-10,atol=1.0e-8,max_steps=10000):
+  import numpy
+  t_end,T,C = numpy.broadcast_arrays(numpy.asarray(years,dtype=float) * constants.year,
+                                     initial_temperature,
+                                     get_heat_capacity(numpy.asarray(water_depth)))
+  shape     = T.shape
+  t_end,T,C = [a.astype(float).ravel() for a in (t_end,T,C)]
+  t         = numpy.zeros_like(t_end)
+  T_eq      = get_equilibrium_temperature()
+  h         = 0.1 * C / (4 * epsilon * constants.sigma * T_eq**3)    # a tenth of the relaxation time
+  for step in range(max_steps):
+    settled    = abs(T - T_eq) <= atol + rtol*T_eq
+    T[settled] = T_eq
+    t[settled] = t_end[settled]
+    active     = numpy.flatnonzero(t < t_end)
+    if len(active)==0:
+      T = T.reshape(shape)
+      return (T,heat_flux_out_calc(T))
+    y      = T[active]
+    c      = C[active]
+    dt     = numpy.minimum(h[active],t_end[active]-t[active])
+    k      = []
+    for a in DORMAND_PRINCE_A:
+      k.append(get_temperature_derivative(y + dt*sum(ai*ki for ai,ki in zip(a,k)),c))
+    y5     = y + dt*sum(ai*ki for ai,ki in zip(DORMAND_PRINCE_A[-1],k))
+    error  = dt*abs(sum(ei*ki for ei,ki in zip(DORMAND_PRINCE_E,k))) / (atol + rtol*numpy.maximum(abs(y),abs(y5)))
+    accept = error <= 1
+    t[active[accept]] += dt[accept]
+    T[active[accept]]  = y5[accept]
+    with numpy.errstate(divide='ignore'):
+      h[active] = dt * numpy.clip(0.9*error**-0.2,0.2,5)
+  raise RuntimeError('Integration did not finish in {0} steps'.format(max_steps))
+
+# get_equilibrium
+#
+# Temperature when the planet has reached equilibrium, for when only the
+# final state matters; years and initial_temperature are ignored.
+
+def get_equilibrium(years,water_depth,initial_temperature=0):
+  import numpy
+  T = numpy.full(numpy.broadcast(years,water_depth,initial_temperature).shape,get_equilibrium_temperature())
+  return (T,heat_flux_out_calc(T))
+
+INTEGRATORS = {'analytic'    : solve_naked_planet,
+               'adaptive'    : integrate_naked_planet,
+               'equilibrium' : get_equilibrium}
+
+# iterate_naked_planets
+#
+# Vectorized version of iterate_naked_planet, without plotting, for an array
+# of numbers of steps: each planet stops once it has taken its steps. The
+# arithmetic is the same, so the results are the same.
+
+def iterate_naked_planets(steps,y_time_step,water_depth,initial_temperature=0):
+  import numpy
+  steps                = numpy.asarray(steps)
+  water_column         = water_depth * Density_water
+  heat_capacity        = water_column * constants.calorie /constants.gram
+  heat_flux_in         = L * (1 - albedo) /4
+  temperature          = numpy.full(len(steps),initial_temperature,dtype=float)
+  heat_stored_in_water = heat_capacity*temperature
+  for i in range(int(steps.max(initial=0))):
+    active                        = numpy.flatnonzero(steps>i)
+    heat_flux_nett                = heat_flux_in - heat_flux_out_calc(temperature[active])
+    heat_stored_in_water[active] += heat_flux_nett * y_time_step * constants.year
+    temperature[active]           = heat_stored_in_water[active]/heat_capacity
+  return (temperature,heat_flux_out_calc(temperature))
+
+# run_batch
+#
+# Do what the grader does for many records: each line has a number of steps.
+# Records are evaluated in chunks, and T and heat flux written for each,
+# one line per record.
+
+def run_batch(lines,y_time_step,water_depth,initial_temperature=0,out=sys.stdout,chunk_size=10000,integrator='euler'):
+  lines = (line for line in lines if len(line.strip())>0)
+  while True:
+    chunk = [int(line) for line in itertools.islice(lines,chunk_size)]
+    if len(chunk)==0:
+      return
+    if integrator=='euler':
+      Ts,Fs = iterate_naked_planets(chunk,y_time_step,water_depth,initial_temperature)
+    else:
+      import numpy
+      Ts,Fs = INTEGRATORS[integrator](numpy.array(chunk)*y_time_step,water_depth,initial_temperature)
+    out.write(''.join(['{0} {1}\n'.format(T if steps>0 or integrator!='euler' else initial_temperature,F)   # as grader, if no steps
+                       for steps,T,F in zip(chunk,Ts.tolist(),Fs.tolist())]))
+
 def plot(time_list, temperature_list,name):
   plt.plot( time_list, temperature_list)
   plt.xlabel('Time')
@@ -92,6 +265,13 @@ def help():
   print ('To specify timesetp and water depth, use the -t and -w options')
   print ('   NB timestep may be a fraction of a year. e.g.')
   print ('   python naked.py -p -s 600 -n foo.png -t 0.05 -w 1')
+  print ('To do what the grader does for many numbers of steps, one on each line of')
+  print ('files, or of standard input if there are no files, enter:')
+  print ('   python naked.py -b [files]')
+  print ('To calculate the temperature after the same number of years without time')
+  print ('steps, use the -i option with one of: {0}, e.g.'.format(', '.join(INTEGRATORS)))
+  print ('   python naked.py -i analytic -s 600')
+  print ('The default, euler, takes time steps as the grader does')
 
 
 # This is the main program. We use command line parameters to have a single
@@ -105,12 +285,15 @@ if __name__=='__main__':
   name                = 'naked.png'      # for saving plot
   initial_temperature = 0
   debug               = False
+  batch               = False
+  integrator          = 'euler'
   
   try:
     opts, args = getopt.getopt( \
           sys.argv[1:],\
-          'hps:n:t:w:k:d',\
-          ['help','plot','steps=','name=','timestep=','waterdepth=','initialtemperature','debug'])
+          'hps:n:t:w:k:dbi:',\
+          ['help','plot','steps=','name=','timestep=','waterdepth=','initialtemperature','debug','batch',
+           'integrator='])
   except getopt.GetoptError:
     help()
     sys.exit(2)
@@ -135,10 +318,26 @@ if __name__=='__main__':
       print (initial_temperature)
     elif opt in ['-d','debug']:
         debug = True    
-    
+    elif opt in ['-b','--batch']:
+        batch = True
+    elif opt in ['-i','--integrator']:
+      if arg!='euler' and arg not in INTEGRATORS:
+        help()
+        sys.exit(2)
+      integrator = arg
+
+  if batch:
+    import fileinput
+    run_batch(fileinput.input(args),y_time_step,water_depth,initial_temperature,integrator=integrator)
+    sys.exit()
+
   print (water_depth)      
   if number_of_steps<0:
     number_of_steps = int(input(""))
     
-  T,F=iterate_naked_planet(number_of_steps,must_plot,name,y_time_step,water_depth)
+  if integrator=='euler':
+    T,F=iterate_naked_planet(number_of_steps,must_plot,name,y_time_step,water_depth)
+  else:
+    T,F=INTEGRATORS[integrator](number_of_steps*y_time_step,water_depth,initial_temperature)
+    T,F=float(T),float(F)
   print (T,F)
\ No newline at end of file
@@ -16,24 +16,53 @@
 # A Model of Climate Chanhge Today
 # https://www.coursera.org/learn/global-warming-model/home/week/5
 
-import math,matplotlib.pyplot as plt
+import sys,getopt,math,copy,collections,numpy
 
 co2_at_equilibrium         = 280.0    # ppm
 co2_initial                = 290.0    # ppm
 co2_growth_exponent        = 0.0225   # per year
 time_response              = 20       # Years
 watts_m2_sx                = 4        # radiative forcing due to doubled CO2 
+airborne_fraction          = 0.45     # fraction of emitted CO2 that stays in the atmosphere
+ppm_per_GtC                = 1/2.124  # ppm CO2 for each GtC in the atmosphere
+
+# The scenarios are calculated using numpy, for whole arrays of years at once.
+# The parameters co2_initial, climate_sensitivity_2x, and aerosol_Wm2_now
+# may be arrays, in which case there is one scenario for each element, and
+# the results have an extra (last) axis for the years. E.g.
+#     business_as_usual(climate_sensitivity_2x=numpy.linspace(1,6,1000),time_step=1)
+# calculates 1000 scenarios, and returns CO2 etc. as arrays of shape (1000,201).
+# The constants co2_growth_exponent, time_response, and watts_m2_sx may be
+# overridden, by scenario, using the arguments growth, response, and forcing_2x.
+
+# Make a parameter, which may be an array with one value for each scenario,
+# broadcast against arrays whose last axis is years. If value is None, use default.
+
+def by_scenario(value,default):
+    return default if value is None else numpy.expand_dims(value,-1)
 
 # Calculate radiative forcing from CO2
 #
-# Input:   CO2 ppm
+# Input:   CO2 ppm (number or array)
 # Output: Radiative Forcing W/(m*m)
 
-def get_rf(co2):            # CO2 ppm
+def get_rf(co2,             # CO2 ppm
+           forcing_2x=None):  # overrides watts_m2_sx
     # A function to determine the number of doubleins of CO2 compared to equilibrium
     def number_of_doublings_of_co2():
-        return  math.log( co2/co2_at_equilibrium ) / math.log(2.0)
-    return watts_m2_sx * number_of_doublings_of_co2()
+        return  numpy.log( numpy.divide(co2,co2_at_equilibrium) ) / math.log(2.0)
+    return by_scenario(forcing_2x,watts_m2_sx) * number_of_doublings_of_co2()
+
+# get_index
+#
+# Find the index of a year in the years used for a simulation, which are
+# equally spaced. Raises ValueError if year isn't one of them.
+
+def get_index(years,year):
+    index = int(numpy.searchsorted(years,year))
+    if index >= len(years) or years[index] != year:
+        raise ValueError('{0} is not in years'.format(year))
+    return index
 
 # Calculate aerosol coefficient
 #
@@ -46,9 +75,149 @@ def get_aerosol_coefficient(years,             # The years used in the simulatio
                             co2,               # CO2 ppm for each year
                             aerosol_Wm2_now,   # The masking effect for the target year
                             year=2015):        # The target year
-    index = years.index(year)
-    return aerosol_Wm2_now/((co2[index]-co2[index-1])/(years[index] - years[index-1]))  
-    
+    index = get_index(years,year)
+    return aerosol_Wm2_now/((co2[...,index]-co2[...,index-1])/(years[index] - years[index-1]))
+
+# get_co2
+#
+# CO2 for business as usual: the excess over equilibrium grows exponentially,
+# so CO2 is calculated in closed form for all years at once.
+
+def get_co2(years,co2_initial=co2_initial,growth=None):
+    factor = (1 + by_scenario(growth,co2_growth_exponent))**(years - years[0])
+    return co2_at_equilibrium + numpy.expand_dims(numpy.subtract(co2_initial,co2_at_equilibrium),-1) * factor
+
+# get_rf_mask
+#
+# Masking by aerosols, which is proportional to the rate of increase of CO2,
+# but never stronger than aerosol_Wm2_now. Returns values for the second
+# and subsequent years.
+
+def get_rf_mask(co2,time_step,aerosol_coefficient,aerosol_Wm2_now):
+    rate = numpy.diff(co2,axis=-1)/time_step
+    return numpy.maximum(rate*numpy.expand_dims(aerosol_coefficient,-1),numpy.expand_dims(aerosol_Wm2_now,-1))
+
+# get_temp_trans
+#
+# The transient temperature relaxes towards the equilibrium temperature:
+#     temp_trans[i] = temp_trans[i-1] + (temp_eq[i]-temp_trans[i-1])*time_step/time_response
+# which is a first order linear filter, so scipy.signal.lfilter does the whole
+# recursion, for every scenario, in compiled code. temp_trans[0] is initial.
+# If response (overriding time_response) varies by scenario, the filter
+# differs for each scenario, so we step through the years instead, updating
+# every scenario at once.
+
+def get_temp_trans(temp_eq,time_step,initial=0.0,response=None):
+    temp_eq    = numpy.asarray(temp_eq,dtype=float)
+    initial    = numpy.broadcast_to(initial,temp_eq.shape[:-1])
+    temp_trans = numpy.empty_like(temp_eq)
+    temp_trans[...,0] = initial
+    if numpy.ndim(response) == 0:
+        from scipy.signal import lfilter
+        alpha = time_step/(time_response if response is None else response)
+        temp_trans[...,1:],_ = lfilter([alpha],[1,alpha-1],temp_eq[...,1:],axis=-1,
+                                       zi=numpy.expand_dims((1-alpha)*initial,-1))
+    else:
+        alpha = numpy.broadcast_to(numpy.divide(time_step,response),temp_eq.shape[:-1])
+        for i in range(1,temp_eq.shape[-1]):
+            temp_trans[...,i] = temp_trans[...,i-1]+(temp_eq[...,i]-temp_trans[...,i-1])*alpha
+    return temp_trans
+
+# ScenarioCache
+#
+# Results of scenarios, keyed by their parameters, so repeated calls share
+# one calculation. When maxsize is exceeded, the least recently used result is
+# discarded. Arrays in results are made read-only, so callers can share them
+# without copying: copy before modifying.
+
+class ScenarioCache:
+    def __init__(self,maxsize=32):
+        self.maxsize = maxsize
+        self.results = collections.OrderedDict()
+        self.hits    = 0
+        self.misses  = 0
+
+    # Look up result for key, calculating it using calculate() if it isn't cached
+
+    def get(self,key,calculate):
+        if key in self.results:
+            self.hits += 1
+            self.results.move_to_end(key)
+            return self.results[key]
+        self.misses += 1
+        result = calculate()
+        for array in result:
+            array.flags.writeable = False
+        self.results[key] = result
+        if len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+        return result
+
+    def clear(self):
+        self.results.clear()
+        self.hits   = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.results)
+
+    def __str__(self):
+        return 'hits={0}, misses={1}, size={2}, maxsize={3}'.format(self.hits,self.misses,len(self),self.maxsize)
+
+scenario_cache = ScenarioCache()
+
+# get_temp_eq
+#
+# Radiative forcing and equilibrium temperature for CO2 pathways: co2 has
+# one row for each scenario, and one column for each year. By default, the
+# aerosol_coefficient is chosen so the masking matches aerosol_Wm2_now in 2015.
+# NB: the radiative forcing, and temperature, for the first year are taken to be zero.
+
+def get_temp_eq(years,
+                co2,
+                climate_sensitivity_2x = 3.0,
+                aerosol_Wm2_now=-0.75,
+                forcing_2x=None,          # overrides watts_m2_sx
+                aerosol_coefficient=None):
+    time_step      = years[1]-years[0]
+    rfco2          = get_rf(co2,forcing_2x)
+    rfco2[...,0]   = 0
+    if aerosol_coefficient is None:
+        aerosol_coefficient = get_aerosol_coefficient(years,co2,aerosol_Wm2_now)
+
+    climateSensitivityWM2 = numpy.expand_dims(climate_sensitivity_2x,-1)/by_scenario(forcing_2x,watts_m2_sx)
+    temp_eq               = numpy.zeros_like(rfco2)
+    temp_eq[...,1:]       = climateSensitivityWM2*(rfco2[...,1:] + get_rf_mask(co2,time_step,aerosol_coefficient,aerosol_Wm2_now))
+    return (rfco2,temp_eq)
+
+# get_temperatures
+#
+# The engine shared by all scenarios: calculate radiative forcing, equilibrium and
+# transient temperatures for CO2 pathways, all scenarios at once.
+# Returns (rfco2,temp_eq,temp_trans)
+
+def get_temperatures(years,
+                     co2,
+                     climate_sensitivity_2x = 3.0,
+                     aerosol_Wm2_now=-0.75,
+                     response=None,        # overrides time_response
+                     forcing_2x=None):     # overrides watts_m2_sx
+    rfco2,temp_eq = get_temp_eq(years,co2,climate_sensitivity_2x,aerosol_Wm2_now,forcing_2x)
+    return (rfco2,temp_eq,get_temp_trans(temp_eq,years[1]-years[0],response=response))
+
+# get_co2_from_emissions
+#
+# CO2 pathways from emissions of carbon, in GtC per year, from the previous year
+# to each year; the emissions for the first year are ignored.
+
+def get_co2_from_emissions(years,emissions,co2_initial=co2_initial):
+    emissions = numpy.asarray(emissions,dtype=float)
+    co2       = numpy.empty_like(emissions)
+    co2[...,0]  = co2_initial
+    co2[...,1:] = numpy.expand_dims(co2_initial,-1) + \
+                  numpy.cumsum(emissions[...,1:]*numpy.diff(years),axis=-1)*airborne_fraction*ppm_per_GtC
+    return co2
+
 #  Compute business as usual scenario
 #
 #  Inputs:
@@ -56,48 +225,50 @@ def get_aerosol_coefficient(years,             # The years used in the simulatio
 #       end         Last Year
 #       co2_initial CO2 ppm at start of first year
 #
-# Return (years,co2,rfco2,temp_eq,temp_trans)
+# Return (years,co2,rfco2,temp_eq,temp_trans), as numpy arrays
 #
-# We can caluclate the CO2 and the radiative forcing in one loop, but the
-# rf masking and temperatures depend on the aerosol_coefficient, which reqires
-# the CO2, so there will be two loops
+# The CO2 and the radiative forcing are calculated first, but the rf masking
+# and temperatures depend on the aerosol_coefficient, which reqires the CO2.
+# NB: the radiative forcing for the first year is taken to be zero.
+#
+# Scenarios with a single value for each parameter, and default constants, are
+# cached in scenario_cache (unless it is None), so the arrays are read-only.
 
 def business_as_usual(start=1900,
                       end=2100,
                       co2_initial=co2_initial,
                       climate_sensitivity_2x = 3.0,
                       aerosol_Wm2_now=-0.75,
-                      time_step=5):
-    years=[year for year in range(start,end+1,time_step)]
-    
-    co2 = [co2_initial]  # Initialize CO2 ppm
-    rfco2 = [0]          # Initialize radiative forcing
+                      time_step=5,
+                      growth=None,          # overrides co2_growth_exponent
+                      response=None,        # overrides time_response
+                      forcing_2x=None):     # overrides watts_m2_sx
+    key = (start,end,co2_initial,climate_sensitivity_2x,aerosol_Wm2_now,time_step)
+    if scenario_cache is not None and growth is None and response is None and forcing_2x is None \
+       and all(numpy.ndim(value)==0 for value in key):
+        key = tuple(numpy.asarray(value).item() for value in key)   # 0-d arrays can't be hashed
+        return scenario_cache.get(key + (co2_growth_exponent,time_response,watts_m2_sx),
+                                  lambda: calculate_business_as_usual(*key))
+    return calculate_business_as_usual(*key,growth=growth,response=response,forcing_2x=forcing_2x)
+
+def calculate_business_as_usual(start,end,co2_initial,climate_sensitivity_2x,aerosol_Wm2_now,time_step,
+                                growth=None,response=None,forcing_2x=None):
+    years = numpy.arange(start,end+1,time_step)
+    shape = numpy.broadcast(*[value for value in [co2_initial,climate_sensitivity_2x,aerosol_Wm2_now,
+                                                  growth,response,forcing_2x] if value is not None]).shape
+    co2   = get_co2(years,numpy.broadcast_to(co2_initial,shape),growth)
+    return (years,co2) + get_temperatures(years,co2,climate_sensitivity_2x,aerosol_Wm2_now,response,forcing_2x)
+
+# This function is used by world_without_us to find where the CO2 crosses a specific threshold.
+# If values is a 2D array, it returns an array of indices, one for each row.
+# If values never reach threshold, the index is len(values).
 
-    for year in years[1:]:
-        co2.append(co2_at_equilibrium + (co2[-1]-co2_at_equilibrium) * (1 + co2_growth_exponent)**time_step)
-        rfco2.append(get_rf(co2[-1]))
-
-    aerosol_coefficient = get_aerosol_coefficient(years,co2,aerosol_Wm2_now)
-    
-    temp_eq=[0]
-    temp_trans=[0]
-    climateSensitivityWM2      = climate_sensitivity_2x/watts_m2_sx
-    for i in range(1,len(years)):
-        rfmask=max(((co2[i]-co2[i-1])/time_step)*aerosol_coefficient,aerosol_Wm2_now)
-        rf_total=rfco2[i]+rfmask
-        temp_eq.append(climateSensitivityWM2*rf_total)
-        temp_trans.append(temp_trans[-1]+(temp_eq[-1]-temp_trans[-1])*time_step/time_response)
-        
-    return (years,co2,rfco2,temp_eq,temp_trans)
-
-# This function is used by world_without_us to find where the CO2 crosses a specific threshold
 def find_index_threshold_crossing(values,        # Values to search - e.g. CO2
                                   threshold):    # We want to find the index
                                                  # of the first position in values
                                                  # that exceeds thrshold
-    for i in range(len(values)):
-        if values[i]>=threshold:
-            return i
+    crossed = numpy.asarray(values) >= threshold
+    return numpy.where(numpy.any(crossed,axis=-1),numpy.argmax(crossed,axis=-1),crossed.shape[-1])
 
 # This function is used by world_without_us to decide how much to relax CO2
 
@@ -108,7 +279,8 @@ def relax_co2(co2,
     return ( target_for_relaxing_co2 - co2 ) * ( time_step / timescale_for_relaxing_co2)
 
 # Calculate values for World without Us. It is meant to be executed after
-# Business as Usual
+# Business as Usual. After the threshold is crossed, CO2 relaxes towards
+# its target by a constant fraction every step, so it is calculated in closed form.
 #
 
 def world_without_us(years,           # The years used for the Business as Usual Calculation
@@ -123,63 +295,489 @@ def world_without_us(years,           # The years used for the Business as Usual
                      threshold=400,   # W=orld Without Us begins to diverge
                                       # from Business as Usual after
                                       # CP2 ppm exceeds thrshold
-                     climate_sensitivity_2x = 3.0): # Degrees per doubling
+                     climate_sensitivity_2x = 3.0,  # Degrees per doubling
+                     target_for_relaxing_co2=340,
+                     timescale_for_relaxing_co2 = 100,
+                     response=None,        # overrides time_response
+                     forcing_2x=None):     # overrides watts_m2_sx
     time_step = years[1]-years[0]
-    index = find_index_threshold_crossing(co2_bau,threshold)
+    index     = numpy.expand_dims(find_index_threshold_crossing(co2_bau,threshold),-1)
+    steps     = numpy.arange(len(years)) - index + 1    # Steps since last year of Business as Usual
+    after     = steps > 0                               # Years after we cross threshold
+
+    # CO2 in the last year of Business as Usual, from which we relax
+    co2_start = numpy.take_along_axis(co2_bau,numpy.maximum(index-1,0),axis=-1)
+    co2_wwu   = target_for_relaxing_co2 + (co2_start-target_for_relaxing_co2) * \
+                (1 - time_step / timescale_for_relaxing_co2)**numpy.maximum(steps,0)
+
+    # Now calculate data after threshold crossing: without us, there are no aerosols
+    co2                = numpy.where(after,co2_wwu,co2_bau)
+    rfco2_wwu,temp_wwu = get_temp_eq(years,co2,climate_sensitivity_2x,0,forcing_2x,aerosol_coefficient=0)
+    rfco2      = numpy.where(after,rfco2_wwu,rfco2_bau)
+    temp_eq    = numpy.where(after,temp_wwu,temp_eq_bau)
+    temp_trans = get_temp_trans(temp_eq,time_step,response=response)
 
-    co2 = co2_bau[:index]                # Initialize for years before we cross threshold
-    rfco2 = rfco2_bau[:index]            # Initialize for years before we cross threshold
-    temp_eq = temp_eq_bau[:index]        # Initialize for years before we cross threshold
-    temp_trans = temp_trans_bau[:index]  # Initialize for years before we cross threshold
-    
-    # Now calculate data after threshold crossing
-    climateSensitivityWM2      = climate_sensitivity_2x/watts_m2_sx
-    
-    while (len(co2)<len(years)):
-        co2.append(co2[-1]+relax_co2(co2[-1],time_step))
-        rfco2.append(get_rf(co2[-1]))
-        temp_eq.append(climateSensitivityWM2*rfco2[-1])
-        temp_trans.append(temp_trans[-1]+(temp_eq[-1]-temp_trans[-1])*time_step/time_response) 
-        
     return (co2,rfco2,temp_eq,temp_trans)
 
+# run_pathways
+#
+# Evaluate a library of pathways, given as either CO2 (ppm) or emissions (GtC per
+# year), with one row for each scenario and one column for each year. The
+# pathways may be memory mapped (e.g. numpy.load(path,mmap_mode='r')), in which
+# case chunk_size limits the number of rows in memory at once; the results may
+# be written to out, a tuple of 4 arrays of the same shape (e.g. from
+# numpy.lib.format.open_memmap). Parameters may be numbers, or have one value
+# for each row. Returns (co2,rfco2,temp_eq,temp_trans).
+
+def run_pathways(years,
+                 co2=None,
+                 emissions=None,
+                 co2_initial=co2_initial,  # used with emissions
+                 climate_sensitivity_2x = 3.0,
+                 aerosol_Wm2_now=-0.75,
+                 response=None,        # overrides time_response
+                 forcing_2x=None,      # overrides watts_m2_sx
+                 chunk_size=None,
+                 out=None):
+    if (co2 is None) == (emissions is None):
+        raise ValueError('Specify either co2 or emissions')
+    pathways   = co2 if emissions is None else emissions
+    n          = len(pathways)
+    chunk_size = n if chunk_size is None else chunk_size
+    if out is None:
+        out = tuple(numpy.empty(numpy.shape(pathways)) for _ in range(4))
+
+    def rows(value,first,last):
+        return value if value is None or numpy.ndim(value)==0 else value[first:last]
+
+    for first in range(0,n,chunk_size):
+        last  = min(first+chunk_size,n)
+        chunk = numpy.asarray(pathways[first:last],dtype=float)
+        if emissions is not None:
+            chunk = get_co2_from_emissions(years,chunk,rows(co2_initial,first,last))
+        results = (chunk,) + get_temperatures(years,chunk,
+                                              rows(climate_sensitivity_2x,first,last),
+                                              rows(aerosol_Wm2_now,first,last),
+                                              rows(response,first,last),
+                                              rows(forcing_2x,first,last))
+        for target,result in zip(out,results):
+            target[first:last] = result
+    return out
+
 # get_climate_sensitivity_2x
 #
 # Helper funtion used by code tricks 1 and 3
 #
 # This function accepts a valus for aerosol_Wm2_now and determines the value
 # of climate_sensitivity_2x which would give a specified target tmperature in a specified year.
-
+#
+# The aerosol masking doesn't depend on climate_sensitivity_2x, so the
+# equilibrium temperature, and hence the transient temperature, are
+# proportional to it. So we evaluate the model at both ends of the range, in
+# one call, and interpolate, then check the result with a second call. If the
+# residual is too large (which would mean that the model is no longer linear),
+# we fall back to Brent's method, starting from the same bracket.
+#
+# Returns climate_sensitivity_2x, or, if full_output is True,
+# (climate_sensitivity_2x, info), where info is a dictionary with the number of
+# iterations and model evaluations, the method used, and the final residual.
+# Raises ValueError if the range doesn't bracket the target, or if Brent's method
+# doesn't converge within max_iterations.
 
 def get_climate_sensitivity_2x(target_temp=0.8,
                                target_year=2015,
-                               aerosol_Wm2_now=-0.75):
-    # Equation solver
-    # Good old fashioned, but reliable, binary search will do (performance is acceptable).
-    # The solver assumes that xmin<= xmax, and the solution is within the range
-    # It isn't bulletproof (may run forever if assumption violated) but, I haven't
-    # seen this behaviour - and I don't expect it, given the physics!
-    
-    def solve(f,                        # solve f(x)==0
-              xmin,                     # Assume solution>xmin
-              xmax):                    # Assume solution<xmax
-        x=0.5*(xmin+xmax)               # Mid point
-        if xmax<xmin: return x          # Endpoints of range have converged
-        y=f(x)
-        if y<0: return solve(f,x,xmax)  # Solution is in top half of range
-        if y>0: return solve(f,xmin,x)  # Solution is in lower half of range
-        return x   
-    
+                               aerosol_Wm2_now=-0.75,
+                               xmin=0,               # Assume solution>=xmin
+                               xmax=10,              # Assume solution<=xmax
+                               xtol=1.E-12,          # Tolerance for climate_sensitivity_2x
+                               ftol=1.E-10,          # Tolerance for temperature, degrees
+                               max_iterations=100,
+                               full_output=False):
+    evaluations = 0
+
     # This is the function we are going to save for. Notice that we've subtracted the target_temperature,
-    # so equation solver can use standard form (f(x)==0)
+    # so equation solver can use standard form (f(x)==0). x may be an array.
     def get_transient_temperature(climate_sensitivity_2x):
-        (_,_,_,_,temp_trans)=business_as_usual(climate_sensitivity_2x=climate_sensitivity_2x,aerosol_Wm2_now=aerosol_Wm2_now)
-        return temp_trans[index_target]-target_temp
-
-    (years,_,_,_,_)=business_as_usual(climate_sensitivity_2x=0,aerosol_Wm2_now=aerosol_Wm2_now)
-    index_target=years.index(target_year)
-    return solve(get_transient_temperature,0,10)
+        nonlocal evaluations
+        evaluations += 1
+        (years,_,_,_,temp_trans)=business_as_usual(climate_sensitivity_2x=climate_sensitivity_2x,aerosol_Wm2_now=aerosol_Wm2_now)
+        return temp_trans[...,get_index(years,target_year)]-target_temp
+
+    def result(x,iterations,method,residual):
+        info = {'iterations':iterations,'evaluations':evaluations,'method':method,'residual':residual}
+        return (x,info) if full_output else x
+
+    fmin,fmax = get_transient_temperature(numpy.array([xmin,xmax],dtype=float))
+    if fmin == 0: return result(float(xmin),0,'bracket',0.0)
+    if fmax == 0: return result(float(xmax),0,'bracket',0.0)
+    if numpy.sign(fmin) == numpy.sign(fmax):
+        raise ValueError('Target temperature {0} is not reached for climate sensitivity between {1} and {2}'.format(
+                         target_temp,xmin,xmax))
+
+    # Linear interpolation (one secant step)
+    x = xmin - fmin*(xmax-xmin)/(fmax-fmin)
+    y = get_transient_temperature(x)
+    if abs(y) <= ftol:
+        return result(float(x),1,'linear',float(y))
+
+    from scipy.optimize import brentq
+    x,convergence = brentq(get_transient_temperature,xmin,xmax,xtol=xtol,maxiter=max_iterations,
+                           full_output=True,disp=False)
+    if not convergence.converged:
+        raise ValueError('Solver did not converge in {0} iterations'.format(max_iterations))
+    return result(float(x),1+convergence.iterations,'brent',float(get_transient_temperature(x)))
  
+# get_climate_sensitivity_table
+#
+# Solve for climate_sensitivity_2x for many combinations of target temperature,
+# target year, and aerosol_Wm2_now at once. The arguments are broadcast
+# against each other, or, if grid is True, every combination is solved, so
+#     get_climate_sensitivity_table(numpy.linspace(0.5,1.5,1000),aerosol_Wm2_now=numpy.linspace(-2,0,1000),grid=True)
+# solves a 1000x1000 grid.
+#
+# CO2 and its radiative forcing don't depend on climate sensitivity or aerosols,
+# so they are calculated once and shared. The transient temperature for unit
+# climate sensitivity is calculated for each aerosol level, and, since
+# temperature is proportional to sensitivity, each target is solved by a division.
+#
+# Returns a numpy structured array, with one row for each problem, and columns
+# target_temp, target_year, aerosol_Wm2_now, climate_sensitivity_2x, and valid, which
+# is False if the sensitivity is outside [xmin,xmax], or there is no solution,
+# in which case climate_sensitivity_2x is NaN.
+
+def get_climate_sensitivity_table(target_temp=0.8,
+                                  target_year=2015,
+                                  aerosol_Wm2_now=-0.75,
+                                  grid=False,
+                                  start=1900,
+                                  end=2100,
+                                  time_step=5,
+                                  xmin=0,
+                                  xmax=10):
+    if grid:
+        target_temp,target_year,aerosol_Wm2_now = numpy.meshgrid(target_temp,target_year,aerosol_Wm2_now,indexing='ij')
+    target_temp,target_year,aerosol_Wm2_now = numpy.broadcast_arrays(target_temp,target_year,aerosol_Wm2_now)
+
+    years   = numpy.arange(start,end+1,time_step)
+    indices = numpy.searchsorted(years,target_year)
+    if numpy.any(indices >= len(years)) or numpy.any(years[numpy.minimum(indices,len(years)-1)] != target_year):
+        raise ValueError('Target years must be in years')
+    co2     = get_co2(years)
+    rfco2   = get_rf(co2)
+    rfco2[0]= 0
+
+    # Transient temperature for unit sensitivity, for each distinct aerosol level
+    aerosols,aerosol_index = numpy.unique(aerosol_Wm2_now,return_inverse=True)
+    coefficient            = get_aerosol_coefficient(years,co2,aerosols)
+    temp_eq                = numpy.zeros((len(aerosols),len(years)))
+    temp_eq[:,1:]          = (rfco2[1:] + get_rf_mask(co2,time_step,coefficient,aerosols))/watts_m2_sx
+    temp_trans             = get_temp_trans(temp_eq,time_step)
+
+    unit  = temp_trans[aerosol_index.reshape(aerosol_Wm2_now.shape),indices]
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+        sensitivity = target_temp / unit
+    valid = numpy.isfinite(sensitivity) & (sensitivity >= xmin) & (sensitivity <= xmax)
+
+    table = numpy.empty(target_temp.size,dtype=[('target_temp',float),('target_year',int),('aerosol_Wm2_now',float),
+                                                ('climate_sensitivity_2x',float),('valid',bool)])
+    table['target_temp']            = target_temp.ravel()
+    table['target_year']            = target_year.ravel()
+    table['aerosol_Wm2_now']        = aerosol_Wm2_now.ravel()
+    table['climate_sensitivity_2x'] = numpy.where(valid,sensitivity,numpy.nan).ravel()
+    table['valid']                  = valid.ravel()
+    return table
+
+# Monte Carlo ensembles
+#
+# The constants of the model are uncertain, so we sample them, run one member
+# for each sample, and summarize the spread of CO2 and transient temperature
+# by quantiles for each year. Policy studies need ~10**6 members, so members are
+# calculated in vectorized chunks, which may be spread over a process pool, and
+# each chunk is reduced to histograms, from which the quantiles are calculated,
+# rather than keeping every member.
+
+ENSEMBLE_PARAMETERS = ['co2_initial','growth','response','forcing_2x','climate_sensitivity_2x','aerosol_Wm2_now']
+
+# Illustrative distributions, used when members are requested from the command line
+
+EXAMPLE_DISTRIBUTIONS = {'climate_sensitivity_2x' : ('lognormal',math.log(3.0),0.3),
+                         'aerosol_Wm2_now'        : ('uniform',-1.5,-0.3)}
+
+# sample_parameters
+#
+# Draw size values for each parameter in distributions, which maps names from
+# ENSEMBLE_PARAMETERS to one of:
+#     a number                  - the parameter is fixed
+#     (name,arg1,arg2,...)      - rng.name(arg1,arg2,...,size=size), e.g. ('normal',3,0.5)
+#     callable                  - called as f(rng,size)
+# Parameters that don't appear in distributions take their default values.
+
+def sample_parameters(distributions,size,rng):
+    parameters = {}
+    for name,distribution in distributions.items():
+        if name not in ENSEMBLE_PARAMETERS:
+            raise ValueError('Unknown parameter {0}: should be one of {1}'.format(name,', '.join(ENSEMBLE_PARAMETERS)))
+        if callable(distribution):
+            values = distribution(rng,size)
+        elif isinstance(distribution,tuple):
+            values = getattr(rng,distribution[0])(*distribution[1:],size=size)
+        else:
+            values = numpy.full(size,distribution)
+        parameters[name] = numpy.asarray(values,dtype=float)
+    return parameters
+
+# run_members
+#
+# Calculate one member for each set of parameters, for Business as Usual, or
+# World without Us. Returns years, CO2, and transient temperature.
+
+def run_members(parameters,size,start=1900,end=2100,time_step=5,scenario='business_as_usual'):
+    parameters = dict({'co2_initial':numpy.full(size,float(co2_initial))},**parameters)
+    (years,co2,rfco2,temp_eq,temp_trans) = business_as_usual(start=start,end=end,time_step=time_step,**parameters)
+    if scenario=='world_without_us':
+        (co2,_,_,temp_trans) = world_without_us(years,co2,rfco2,temp_eq,temp_trans,
+                                                **{name:parameters[name] for name in ['climate_sensitivity_2x',
+                                                                                       'response','forcing_2x']
+                                                   if name in parameters})
+    elif scenario!='business_as_usual':
+        raise ValueError('Unknown scenario {0}'.format(scenario))
+    return (years,co2,temp_trans)
+
+# StreamingQuantiles
+#
+# Running quantiles, for each year, of values that arrive in chunks of shape
+# (members,years). Each year has a histogram of fixed bins, whose range is set
+# from the first chunk, widened by margin so later chunks rarely fall outside;
+# values that do are counted in the end bins. Quantiles are interpolated
+# within bins, so they are accurate to a small fraction of a bin; exact minimum,
+# maximum and mean are also kept. Accumulators built from the same first chunk
+# can be merged, so chunks can be counted in different processes.
+
+class StreamingQuantiles:
+    def __init__(self,values,bins=1024,margin=0.5):
+        low        = numpy.min(values,axis=0)
+        high       = numpy.max(values,axis=0)
+        width      = high - low
+        width      = numpy.where(width>0,width,1.E-6*numpy.maximum(numpy.abs(high),1))
+        self.low   = low - margin*width
+        self.high  = high + margin*width
+        self.bins  = bins
+        self.clear()
+
+    # An accumulator with the same bins, and no counts
+
+    def empty(self):
+        return copy.copy(self).clear()
+
+    def clear(self):
+        self.counts  = numpy.zeros((len(self.low),self.bins),dtype=numpy.int64)
+        self.minimum = numpy.full(len(self.low),numpy.inf)
+        self.maximum = numpy.full(len(self.low),-numpy.inf)
+        self.total   = numpy.zeros(len(self.low))
+        self.n       = 0
+        return self
+
+    def add(self,values):
+        index = ((values-self.low)*(self.bins/(self.high-self.low))).astype(numpy.int64)
+        numpy.clip(index,0,self.bins-1,out=index)
+        index       += numpy.arange(len(self.low))*self.bins
+        self.counts += numpy.bincount(index.ravel(),minlength=self.counts.size).reshape(self.counts.shape)
+        self.minimum = numpy.minimum(self.minimum,numpy.min(values,axis=0))
+        self.maximum = numpy.maximum(self.maximum,numpy.max(values,axis=0))
+        self.total  += numpy.sum(values,axis=0)
+        self.n      += len(values)
+        return self
+
+    def merge(self,other):
+        self.counts += other.counts
+        self.minimum = numpy.minimum(self.minimum,other.minimum)
+        self.maximum = numpy.maximum(self.maximum,other.maximum)
+        self.total  += other.total
+        self.n      += other.n
+        return self
+
+    def mean(self):
+        return self.total/self.n
+
+    # Quantiles: returns an array of shape (len(quantiles),years)
+
+    def quantiles(self,quantiles=(0.05,0.5,0.95)):
+        cumulative = numpy.cumsum(self.counts,axis=-1)
+        width      = (self.high-self.low)/self.bins
+        result     = numpy.empty((len(quantiles),len(self.low)))
+        for i,q in enumerate(quantiles):
+            target    = q*self.n
+            index     = numpy.minimum(numpy.sum(cumulative<target,axis=-1),self.bins-1)
+            count     = numpy.take_along_axis(self.counts,index[:,None],axis=-1)[:,0]
+            below     = numpy.take_along_axis(cumulative,index[:,None],axis=-1)[:,0] - count
+            fraction  = numpy.clip((target-below)/numpy.maximum(count,1),0,1)
+            result[i] = numpy.clip(self.low+(index+fraction)*width,self.minimum,self.maximum)
+        return result
+
+# run_ensemble_chunk
+#
+# Worker for run_ensemble: sample and calculate one chunk of members, and
+# count them in empty copies of the accumulators.
+
+def run_ensemble_chunk(distributions,size,seed,start,end,time_step,scenario,co2_quantiles,temp_quantiles):
+    parameters         = sample_parameters(distributions,size,numpy.random.default_rng(seed))
+    (_,co2,temp_trans) = run_members(parameters,size,start,end,time_step,scenario)
+    return (co2_quantiles.empty().add(co2),temp_quantiles.empty().add(temp_trans))
+
+# run_ensemble
+#
+# Monte Carlo ensemble: sample parameters from distributions (see sample_parameters),
+# and return years, and quantiles of CO2 and transient temperature, each an
+# array of shape (len(quantiles),years). If full_output is True, also return
+# the StreamingQuantiles accumulators.
+#
+# Each chunk has its own seed, spawned from seed, so results depend on seed and
+# chunk_size, but not on the number of processes. With processes=1, all chunks
+# are calculated in this process. Otherwise a pool of processes is used (all
+# cores if processes is None), so distributions must be picklable: use tuples
+# or module level functions, not lambdas.
+
+def run_ensemble(distributions,
+                 members=10**6,
+                 chunk_size=10**5,
+                 processes=None,
+                 seed=0,
+                 start=1900,
+                 end=2100,
+                 time_step=5,
+                 scenario='business_as_usual',
+                 bins=1024,
+                 quantiles=(0.05,0.5,0.95),
+                 full_output=False):
+    if members < 1:
+        raise ValueError('Number of members must be at least 1, not {0}'.format(members))
+    if chunk_size < 1:
+        raise ValueError('Chunk size must be at least 1, not {0}'.format(chunk_size))
+    sizes = [min(chunk_size,members-first) for first in range(0,members,chunk_size)]
+    seeds = numpy.random.SeedSequence(seed).spawn(len(sizes))
+
+    # The first chunk is calculated here, to fix the bins
+    parameters         = sample_parameters(distributions,sizes[0],numpy.random.default_rng(seeds[0]))
+    (years,co2,temp_trans) = run_members(parameters,sizes[0],start,end,time_step,scenario)
+    co2_quantiles      = StreamingQuantiles(co2,bins=bins)
+    temp_quantiles     = StreamingQuantiles(temp_trans,bins=bins)
+    chunks             = [(distributions,size,chunk_seed,start,end,time_step,scenario,co2_quantiles,temp_quantiles)
+                          for size,chunk_seed in zip(sizes[1:],seeds[1:])]
+
+    co2_quantiles.add(co2)
+    temp_quantiles.add(temp_trans)
+
+    if processes==1 or len(chunks)==0:
+        results = (run_ensemble_chunk(*chunk) for chunk in chunks)
+        for co2_chunk,temp_chunk in results:
+            co2_quantiles.merge(co2_chunk)
+            temp_quantiles.merge(temp_chunk)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            for co2_chunk,temp_chunk in executor.map(run_ensemble_chunk,*zip(*chunks)):
+                co2_quantiles.merge(co2_chunk)
+                temp_quantiles.merge(temp_chunk)
+
+    result = (years,co2_quantiles.quantiles(quantiles),temp_quantiles.quantiles(quantiles))
+    return result + (co2_quantiles,temp_quantiles) if full_output else result
+
+# Export of scenarios
+#
+# Scenarios are written as a table, with one row for each member and year,
+# and columns EXPORT_COLUMNS, to CSV, or to Parquet (which needs pyarrow). Members are
+# calculated and written in chunks, so memory is bounded by chunk_size, however
+# many members are written.
+
+EXPORT_COLUMNS = ['scenario','member','year','co2','rfco2','temp_eq','temp_trans']
+
+# get_scenario_chunks
+#
+# Generate chunks of members for Business as Usual and World without Us, as
+# tuples (scenario,first member,years,co2,rfco2,temp_eq,temp_trans), where each
+# array except years has one row for each member. Parameters are sampled as
+# for run_ensemble, using the same seeds, so with the same seed and chunk_size
+# the members are those that run_ensemble summarizes.
+
+def get_scenario_chunks(distributions={},
+                        members=1,
+                        chunk_size=10**4,
+                        seed=0,
+                        start=1900,
+                        end=2100,
+                        time_step=5):
+    firsts = range(0,members,chunk_size)
+    for first,chunk_seed in zip(firsts,numpy.random.SeedSequence(seed).spawn(len(firsts))):
+        size       = min(chunk_size,members-first)
+        parameters = dict({'co2_initial':numpy.full(size,float(co2_initial))},
+                          **sample_parameters(distributions,size,numpy.random.default_rng(chunk_seed)))
+        bau        = business_as_usual(start=start,end=end,time_step=time_step,**parameters)
+        wwu        = world_without_us(*bau,**{name:parameters[name] for name in ['climate_sensitivity_2x',
+                                                                                  'response','forcing_2x']
+                                               if name in parameters})
+        yield ('BAU',first) + bau
+        yield ('WWU',first,bau[0]) + wwu
+
+# get_columns
+#
+# Convert one chunk from get_scenario_chunks to a dictionary of columns
+
+def get_columns(scenario,first,years,*values):
+    members,n_years = numpy.shape(values[0])
+    columns = {'scenario' : numpy.full(members*n_years,scenario),
+               'member'   : numpy.repeat(numpy.arange(first,first+members),n_years),
+               'year'     : numpy.tile(years,members)}
+    for name,value in zip(EXPORT_COLUMNS[3:],values):
+        columns[name] = numpy.ravel(value)
+    return columns
+
+# write_scenarios
+#
+# Write chunks (e.g. from get_scenario_chunks) to path, as 'csv' or 'parquet';
+# if format is None, it is taken from the extension of path. Returns the
+# number of rows written.
+
+def write_scenarios(path,chunks,format=None):
+    if format is None:
+        format = 'parquet' if path.endswith('.parquet') else 'csv'
+    if format=='csv':
+        return write_csv(path,chunks)
+    elif format=='parquet':
+        return write_parquet(path,chunks)
+    else:
+        raise ValueError('Unknown format {0}: should be csv or parquet'.format(format))
+
+def write_csv(path,chunks):
+    rows = 0
+    with open(path,'w') as out:
+        out.write(','.join(EXPORT_COLUMNS)+'\n')
+        for chunk in chunks:
+            columns = get_columns(*chunk)
+            # str is repr for floats, so values are read back exactly; this is
+            # several times faster than numpy.savetxt
+            lines   = zip(*[map(str,columns[name].tolist()) for name in EXPORT_COLUMNS])
+            out.write(''.join([','.join(line)+'\n' for line in lines]))
+            rows += len(columns['year'])
+    return rows
+
+def write_parquet(path,chunks):
+    try:
+        import pyarrow,pyarrow.parquet
+    except ImportError:
+        raise ImportError('Parquet export needs pyarrow: use CSV, or pip install pyarrow')
+    rows   = 0
+    writer = None
+    try:
+        for chunk in chunks:
+            table = pyarrow.Table.from_pydict(get_columns(*chunk))
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(path,table.schema)
+            writer.write_table(table)
+            rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
 
 # Code Trick https://www.coursera.org/learn/global-warming-model/exam/GQC5B/code-trick-aerosol-masking-and-our-future
 # Question 1
@@ -187,8 +785,9 @@ def get_climate_sensitivity_2x(target_temp=0.8,
 
 def code_trick1(target_temp=0.8,target_year=2015,aerosol_Wm2_now=-0.75):
     global figure_number
+    import matplotlib.pyplot as plt
     (years,co2_bau,rfco2_bau,temp_eq_bau,temp_trans_bau)=business_as_usual()
-    index_target=years.index(target_year)
+    index_target=get_index(years,target_year)
     print ('Transient temperature in {0} is {1:.3f} C'.format(target_year,temp_trans_bau[index_target]))
     plt.plot(years, temp_trans_bau, 'b',label='BAU')
     plt.figure(figure_number)
@@ -203,9 +802,10 @@ def code_trick1(target_temp=0.8,target_year=2015,aerosol_Wm2_now=-0.75):
 
 def code_trick2(target_year=2015,duration=2):
     global figure_number
+    import matplotlib.pyplot as plt
     (years,co2_bau,rfco2_bau,temp_eq_bau,temp_trans_bau)=business_as_usual()
     (_,_,_,temp_trans_wwu)=world_without_us(years,co2_bau,rfco2_bau,temp_eq_bau,temp_trans_bau)
-    index_target=years.index(target_year)
+    index_target=get_index(years,target_year)
     bau2,=plt.plot(years[index_target:index_target+duration], temp_trans_bau[index_target:index_target+duration], 'b',label='BAU')
     wwu2,=plt.plot(years[index_target:index_target+duration], temp_trans_wwu[index_target:index_target+duration],'g',label='WWU')
     plt.figure(figure_number)
@@ -226,6 +826,7 @@ def code_trick3(target_temp=0.8,target_year=2015,aerosol_Wm2_now=-1.5):
 
 def code_trick4():
     global figure_number
+    import matplotlib.pyplot as plt
     aerosol_Wm2_now=-1.5
     climate_sensitivity_2x=code_trick1(aerosol_Wm2_now=aerosol_Wm2_now)
     (years,co2_bau,rfco2_bau,temp_eq_bau,temp_trans_bau)=business_as_usual(climate_sensitivity_2x=climate_sensitivity_2x,aerosol_Wm2_now=aerosol_Wm2_now,time_step=1)
@@ -238,8 +839,8 @@ def code_trick4():
     
     plt.figure(figure_number)
     figure_number+=1
-    low=years.index(2014)-5
-    high=years.index(high_year)+5
+    low=get_index(years,2014)-5
+    high=get_index(years,high_year)+5
     bau2,=plt.plot(years[low:high], temp_trans_bau[low:high], 'b',label='BAU')
     wwu2,=plt.plot(years[low:high], temp_trans_wwu[low:high],'g',label='WWU')
 
@@ -252,6 +853,7 @@ def code_trick4():
 
 def plot_for_code_review():
     global figure_number
+    import matplotlib.pyplot as plt
     (years,co2_bau,rfco2_bau,temp_eq_bau,temp_trans_bau)=business_as_usual()
     (co2_wwu,rfco2_wwu,temp_eq_wwu,temp_trans_wwu)=world_without_us(years,co2_bau,rfco2_bau,temp_eq_bau,temp_trans_bau)
 
@@ -271,7 +873,54 @@ def plot_for_code_review():
     plt.ylabel('T Trans')
     plt.show()
     
+def help():
+    print ('A Model of Climate Change Today')
+    print ('Usage:')
+    print ('   python near-future.py [options]')
+    print ('      -h --help          To get usage instructions')
+    print ('      -e --export        Write Business as Usual and World without Us to this file,')
+    print ('                         instead of showing code tricks and plots')
+    print ('      -f --format        csv or parquet, default from extension of export file')
+    print ('      -n --members       Number of members to export, sampled from EXAMPLE_DISTRIBUTIONS if more than 1')
+    print ('      -c --chunk-size    Number of members calculated and written at once, default 10000')
+    print ('      -s --seed          Seed for sampling members')
+
 if __name__=='__main__':
+    export     = None
+    format     = None
+    members    = 1
+    chunk_size = 10**4
+    seed       = 0
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:],'he:f:n:c:s:',
+                                   ['help','export=','format=','members=','chunk-size=','seed='])
+    except getopt.GetoptError as e:
+        print (e)
+        help()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ['-h','--help']:
+            help()
+            sys.exit()
+        elif opt in ['-e','--export']:
+            export = arg
+        elif opt in ['-f','--format']:
+            format = arg
+        elif opt in ['-n','--members']:
+            members = int(arg)
+        elif opt in ['-c','--chunk-size']:
+            chunk_size = int(arg)
+        elif opt in ['-s','--seed']:
+            seed = int(arg)
+
+    if export is not None:
+        chunks = get_scenario_chunks(EXAMPLE_DISTRIBUTIONS if members>1 else {},
+                                     members=members,chunk_size=chunk_size,seed=seed)
+        print ('Wrote {0} rows to {1}'.format(write_scenarios(export,chunks,format),export))
+        sys.exit()
+
     figure_number = 1
     print ('Code Trick 1: Climate sensitivity 2X={0:.3f} degrees C for doubling CO2'.format(code_trick1()))
     code_trick2()
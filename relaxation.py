@@ -30,8 +30,9 @@
 # If the program is run with the following arguments, it will do
 # what is required by the code review: python relaxation.py -f 1150 -l 1350 -p
 
-import sys, getopt, os, re
-from scipy import constants
+import sys, getopt, os, re, itertools, constants
+
+# numpy is imported only by the functions that need it, so the grader starts quickly
 
 # Constants
 
@@ -44,17 +45,33 @@ epsilon             = 1
 # clip (0.5,0,1)==0.5
 # clip (-0.5,0,1)==0
 # clip (1.5,0,1)==1.0
+# x may be a numpy array, in which case each element is clipped.
 
 def clip(x,low,high):
+  if not isinstance(x,(int,float)):
+    return x.clip(low,high)
   return low if x<low else high if x>high else x
 
 # Find T from L and albedo
 #
 # Use energy balance; heat in=heat radiated out
+# L and albedo may be numpy arrays.
 
 def get_T(L,albedo):
   return (L*(1-albedo)/(4*epsilon*constants.sigma))**0.25
 
+# get_T_as_grader
+#
+# get_T for numpy arrays, taking the power of each element with Python's pow,
+# as the grader does for a single L: numpy's power may differ in the last bit.
+# Used by run_batch, whose output must be exactly what the grader's would be.
+
+def get_T_as_grader(L,albedo):
+  x      = L*(1-albedo)/(4*epsilon*constants.sigma)
+  T      = x.copy()
+  T.flat = [y**0.25 for y in x.ravel().tolist()]
+  return T
+
 # get_latitudu
 #
 # Get ice latitude from Temperatue
@@ -84,8 +101,9 @@ def get_albedo(latitude):
 # step_albedo
 #
 # Refine albedo and calculate corresponding temperature
+# L and albedo may be numpy arrays.
 
-def step_albedo(L,albedo):
+def step_albedo(L,albedo,get_T=get_T):
   T        = get_T(L,albedo)
   latitude = get_latitudu(T)
   albedo   = get_albedo(latitude)
@@ -107,28 +125,281 @@ def get_albedo_from_L(L,albedo,tolerance):
     T,albedo        = step_albedo(L,albedo)    
   return (T,albedo)
 
+# get_albedo_from_Ls
+#
+# Vectorized version of get_albedo_from_L: iterate for arrays of luminosities
+# and initial albedos at once. Each element stops changing once it has converged,
+# so the results agree with calling get_albedo_from_L for each element, to
+# rounding, or exactly if get_T is get_T_as_grader. Close to a fold, a few
+# elements may need thousands of iterations, so once there are no more than
+# few left, they are finished one at a time by get_albedo_from_L, which is
+# quicker than numpy for so few.
+
+def get_albedo_from_Ls(Ls,albedos,tolerance,get_T=get_T,few=10):
+  import numpy
+  Ls,previous = numpy.broadcast_arrays(numpy.asarray(Ls,dtype=float),numpy.asarray(albedos,dtype=float))
+  Ts,albedos  = step_albedo(Ls,previous,get_T)
+  active      = numpy.flatnonzero(abs(albedos-previous)>tolerance)
+  Ls          = Ls.ravel()
+  Ts_flat     = Ts.reshape(-1)
+  albedo_flat = albedos.reshape(-1)
+  while len(active)>few:
+    previous             = albedo_flat[active]
+    T,albedo             = step_albedo(Ls[active],previous,get_T)
+    Ts_flat[active]      = T
+    albedo_flat[active]  = albedo
+    active               = active[abs(albedo-previous)>tolerance]
+  for i in active.tolist():
+    Ts_flat[i],albedo_flat[i] = get_albedo_from_L(float(Ls[i]),float(albedo_flat[i]),tolerance)
+  return (Ts,albedos)
+
+# get_Ls
+#
+# Luminosities from first to last, inclusive, in steps of size step
+
+def get_Ls(first,last,step):
+  import numpy
+  n = int(round(abs(last-first)/step))+1
+  return first + numpy.sign(last-first)*step*numpy.arange(n)
+
 # evolve_model
 #
 # Vary luminosity within specified range, and calculate Temperature
 # For each luminosity, use previously calculated value of albedo as
-# starting point for iterations
-
-def evolve_model(first,last,step,tolerance):
-  print ('From {0:d} to {1:d} by {2:d}. Tolerance={3}'.\
-         format(first,last,step,tolerance))
-  step   = 10
-  albedo = 0.15
-  Ls     = []
-  Ts     = []
-  if last<first:
-    step=-step
-  for L in range(first,last+step,step):
-    T,albedo = get_albedo_from_L(L,albedo,tolerance)
-    print ('{0:d}, {1:0.1f}'.format(L,T))
-    Ls.append(L)
-    Ts.append(T)
+# starting point for iterations. Unless the iterations have converged
+# fully, the result depends on where they start, so sweeps with a tolerance
+# above CONVERGED are done in sequence, one luminosity at a time. Tighter
+# sweeps, e.g. the hysteresis loop with a step of 0.01, use sweep_converged.
+
+CONVERGED = 1.0e-6
+
+def evolve_model(first,last,step,tolerance,verbose=True):
+  if verbose:
+    print ('From {0:g} to {1:g} by {2:g}. Tolerance={3}'.\
+           format(first,last,step,tolerance))
+  Ls = get_Ls(first,last,step)
+  if tolerance <= CONVERGED:
+    Ts = sweep_converged(Ls,tolerance).tolist()
+  else:
+    Ts     = []
+    albedo = 0.15
+    for L in Ls.tolist():
+      T,albedo = get_albedo_from_L(L,albedo,tolerance)
+      Ts.append(T)
+  Ls = Ls.tolist()
+  if verbose:
+    print ('\n'.join(['{0:g}, {1:0.1f}'.format(L,T) for L,T in zip(Ls,Ts)]))
   return (Ls,Ts)
- 
+
+# sweep_converged
+#
+# Vectorized version of the loop in evolve_model, for a tolerance at which the
+# iterations converge, so each luminosity reaches the fixed point on the same
+# branch as the previous one, or the next branch if it has passed a fold.
+#   1. Solve every coarse_step-th luminosity in sequence, then solve all the
+#      others at once, starting from the albedo of the last coarse luminosity.
+#   2. Check all at once that starting from the albedo of the previous
+#      luminosity gives the same albedo, to within the tolerance.
+#   3. Where it doesn't (e.g. close to a fold) fall back to solving in sequence,
+#      until the albedos agree again.
+# Results agree with the loop to within the tolerance of the iterations.
+
+def sweep_converged(Ls,tolerance,coarse_step=100):
+  import numpy
+  coarse  = numpy.arange(0,len(Ls),coarse_step)
+  starts  = []
+  albedo  = 0.15
+  for L in Ls[coarse].tolist():
+    _,albedo = get_albedo_from_L(L,albedo,tolerance)
+    starts.append(albedo)
+  Ts,albedos = get_albedo_from_Ls(Ls,numpy.repeat(starts,coarse_step)[:len(Ls)],tolerance)
+  _,checks   = get_albedo_from_Ls(Ls[1:],albedos[:-1],tolerance)
+  i          = 0
+  for j in numpy.flatnonzero(abs(checks-albedos[1:])>tolerance) + 1:
+    if j <= i: continue          # already solved in sequence
+    i = j
+    while i < len(Ls):
+      T,albedo = get_albedo_from_L(float(Ls[i]),float(albedos[i-1]),tolerance)
+      agree    = abs(albedo-albedos[i]) <= tolerance
+      Ts[i],albedos[i] = T,albedo
+      if agree: break
+      i += 1
+  return Ts
+
+# Continuation
+#
+# The fixed points of the iteration form a curve in the (L,T) plane, which
+# may fold back on itself, giving several temperatures for one luminosity;
+# the hysteresis loop found by evolve_model jumps between these branches at
+# the folds. Here we trace the whole curve by pseudo-arclength continuation:
+# predict a step of length ds along the tangent, then use Newton to return to
+# the curve, keeping the distance along the tangent fixed. The step grows
+# while Newton converges quickly, and shrinks when it doesn't. Folds are where
+# the tangent reverses direction in L, and are located by bisection on the step.
+#
+# Because of clip, the curve has corners, where the ice reaches the equator
+# or the pole, and one fold is a corner. No point beyond a corner is at the
+# right distance along the tangent, so when small steps fail we keep the
+# distance from the last point fixed instead, which turns the corner.
+
+# get_residual
+#
+# Zero where T is consistent with the albedo that it implies. Returns the
+# residual, and its derivatives with respect to L and T.
+
+def get_residual(L,T,h=1.0e-6):
+  albedo     = get_albedo(get_latitudu(T))
+  T_balance  = get_T(L,albedo)
+  dalbedo_dT = (get_albedo(get_latitudu(T+h)) - get_albedo(get_latitudu(T-h)))/(2*h)
+  return (T - T_balance, -T_balance/(4*L), 1 + T_balance*dalbedo_dT/(4*(1-albedo)))
+
+# get_tangent
+#
+# Unit tangent to the curve, (dL/ds,dT/ds). The orientation, +1 or -1, is fixed
+# for the whole curve, so the tangent keeps pointing forward through folds and
+# corners, where it reverses direction in L.
+
+def get_tangent(dF_dL,dF_dT,orientation=1):
+  import numpy
+  return orientation*numpy.array([dF_dT,-dF_dL])/numpy.hypot(dF_dT,dF_dL)
+
+# correct
+#
+# Predict a point at distance ds along the tangent from x, then use Newton to
+# find the point on the curve with the same distance along the tangent, or, if
+# corner is True, at distance ds from x.
+# Returns (point,derivatives,iterations), or (None,None,iterations) if Newton fails.
+
+def correct(x,tangent,ds,tolerance,max_iterations=8,corner=False):
+  import numpy
+  y = x + ds*tangent
+  for i in range(1,max_iterations+1):
+    F,dF_dL,dF_dT = get_residual(*y)
+    if corner:
+      G,dG        = (numpy.dot(y-x,y-x) - ds*ds)/(2*ds),(y-x)/ds
+    else:
+      G,dG        = numpy.dot(tangent,y-x) - ds,tangent
+    try:
+      dy          = numpy.linalg.solve([[dF_dL,dF_dT],dG],[-F,-G])
+    except numpy.linalg.LinAlgError:
+      break
+    y             = y + dy
+    if numpy.max(abs(dy)) < tolerance*max(1,numpy.max(abs(y))):
+      return (y,get_residual(*y)[1:],i+1)
+  return (None,None,max_iterations)
+
+# locate_fold
+#
+# Given that the tangent reverses direction in L between x, and the point at
+# distance ds along the curve, bisect on the step to find the fold: the last
+# point before the tangent reverses, or before the curve turns a corner.
+# Returns (fold,evaluations)
+
+def locate_fold(x,tangent,ds,orientation,tolerance):
+  low,high    = 0,ds
+  evaluations = 0
+  fold        = x
+  while high-low > tolerance*max(1,abs(ds)):
+    middle               = 0.5*(low+high)
+    y,derivatives,count  = correct(x,tangent,middle,tolerance)
+    evaluations         += count
+    if y is not None and get_tangent(*derivatives,orientation)[0]*tangent[0] > 0:
+      low  = middle
+      fold = y
+    else:
+      high = middle
+  return (fold,evaluations)
+
+# trace_branches
+#
+# Trace the curve of fixed points from the coldest solution at L=first, until
+# it reaches the warmest solution at L=last. The curve is split at folds, and
+# each part is a branch, which is stable if the iteration converges there.
+#
+# Returns (branches,folds,evaluations), where each branch is (Ls,Ts,stable),
+# folds is a list of (L,T), and evaluations is the number of residuals calculated.
+
+def trace_branches(first=1150,last=1350,ds=10,ds_min=1.0e-6,ds_max=50,ds_corner=1.0e-3,tolerance=1.0e-9,
+                   max_steps=10000):
+  import numpy
+  T_start,_   = get_albedo_from_L(first,0.65,tolerance)
+  T_end,_     = get_albedo_from_L(last,0.15,tolerance)
+  x           = numpy.array([first,T_start])
+  derivatives = get_residual(*x)[1:]
+  orientation = 1 if get_tangent(*derivatives)[0] > 0 else -1
+  tangent     = get_tangent(*derivatives,orientation)
+  evaluations = 1
+  branches    = []
+  folds       = []
+  points      = [x]
+  stable      = derivatives[1] > 0
+  for step in range(max_steps):
+    if x[0] >= last and x[1] >= T_end - tolerance*T_end:
+      break
+    y,derivatives,count  = correct(x,tangent,ds,tolerance)
+    evaluations         += count
+    if y is None and ds < ds_corner:
+      y,derivatives,count  = correct(x,tangent,ds,tolerance,corner=True)
+      evaluations         += count
+    if y is None:
+      ds = ds/2
+      if ds < ds_min:
+        raise RuntimeError('Continuation failed at L={0}, T={1}'.format(*x))
+      continue
+    new_tangent = get_tangent(*derivatives,orientation)
+    if new_tangent[0]*tangent[0] < 0:
+      fold,count   = locate_fold(x,tangent,ds,orientation,tolerance)
+      evaluations += count
+      points.append(fold)
+      branches.append((numpy.array([p[0] for p in points]),numpy.array([p[1] for p in points]),stable))
+      folds.append((fold[0],fold[1]))
+      points = [fold]
+      stable = derivatives[1] > 0
+    points.append(y)
+    x,tangent = y,new_tangent
+    if count <= 3:
+      ds = min(1.5*ds,ds_max)
+  else:
+    raise RuntimeError('Continuation did not reach L={0} in {1} steps'.format(last,max_steps))
+  points[-1] = numpy.array([last,T_end])   # rather than overshoot
+  branches.append((numpy.array([p[0] for p in points]),numpy.array([p[1] for p in points]),stable))
+  return (branches,folds,evaluations)
+
+# get_chunks
+#
+# Split lines into lists of at most chunk_size non blank lines
+
+def get_chunks(lines,chunk_size):
+  lines = (line for line in lines if len(line.strip())>0)
+  while True:
+    chunk = list(itertools.islice(lines,chunk_size))
+    if len(chunk)==0:
+      return
+    yield chunk
+
+# run_batch
+#
+# Do what the grader does for many records: each line has L, albedo, and the
+# number of iterations. Records are evaluated in chunks, and T and albedo
+# written for each, one line per record, exactly as the grader would write them.
+# The grader fails if there are no iterations, so for such records an error
+# message is written instead.
+
+def run_batch(lines,out=sys.stdout,chunk_size=10000,tolerance=2.0):
+  import numpy
+  for chunk in get_chunks(lines,chunk_size):
+    records           = [line.split() for line in chunk]
+    Ls                = numpy.array([float(L) for L,_,_ in records])
+    albedos           = numpy.array([float(albedo) for _,albedo,_ in records])
+    nIters            = numpy.array([int(nIters) for _,_,nIters in records])
+    Ts                = numpy.full(len(Ls),numpy.nan)
+    for i in range(max(nIters.max(),0)):
+      active                     = numpy.flatnonzero(nIters>i)
+      Ts[active],albedos[active] = get_albedo_from_Ls(Ls[active],albedos[active],tolerance,get_T_as_grader)
+    out.write(''.join(['{0} {1}\n'.format(T,albedo) if n>0 else
+                       'Error: number of iterations must be at least 1\n'
+                       for T,albedo,n in zip(Ts.tolist(),albedos.tolist(),nIters.tolist())]))
+
 # plot
 #
 # Plot temperature against luminosity
@@ -145,6 +416,23 @@ def plot(Ls1,Ts1,Ls2,Ts2,name,tolerance):
   plt.savefig(name)
   plt.show()  
 
+# plot_branches
+#
+# Plot branches from trace_branches: stable branches are solid, unstable dashed
+
+def plot_branches(branches,folds,name):
+  for Ls,Ts,stable in branches:
+    plt.plot(Ls,Ts,'b-' if stable else 'r--')
+  plt.plot([L for L,_ in folds],[T for _,T in folds],'ko',label='Folds')
+  plt.plot([1200,1600],[273.16,273.16],'g--',label='Water<-->Ice')
+  plt.legend(loc='lower right')
+  plt.title('Branches of Temperature vs. Luminosity')
+  plt.grid(True)
+  plt.xlabel('Luminosity')
+  plt.ylabel('Temperature K')
+  plt.savefig(name)
+  plt.show()
+
 # Provide command level help
 
 def help():
@@ -163,7 +451,13 @@ def help():
   print ('      -p --plot      Species that output is to be plotted')
   print ('      -f --fromL     Starting Luminosity')
   print ('      -t --toL       Final Luminosity')
-  print ('      -s --step      Step size for iterating across luminosities')
+  print ('      -s --step      Step size for iterating across luminosities, e.g. 0.01. If the tolerance')
+  print ('                     is at most {0:g}, all luminosities are iterated at once; otherwise'.format(CONVERGED))
+  print ('                     they are iterated in sequence. For the folds of the hysteresis loop, use -c')
+  print ('      -c --continuation Trace all branches, stable and unstable, and find folds')
+  print ('      -b --batch     Grader calculation for each line of the files named after')
+  print ('                     the options, or of standard input: L, albedo, iterations')
+  print ('                     (at least 1, else an error message is written for the line)')
   
 # Determine revision number from subversion
 
@@ -176,11 +470,12 @@ def version(tag='$LastChangedRevision: 890 $'):
 
 if __name__=='__main__':
   must_plot = False
+  must_trace = False
   try:
       opts, args = getopt.getopt( \
             sys.argv[1:],\
-            'hvt:n:pf:l:s:',\
-            ['help','version','tolerance','name','plot','fromL','toL','step'])
+            'hvt:n:pf:l:s:cb',\
+            ['help','version','tolerance','name','plot','fromL','toL','step','continuation','batch'])
   except getopt.GetoptError as e:
     print (e)
     help()
@@ -220,9 +515,27 @@ if __name__=='__main__':
       elif opt in ['-n','--name']:
         name=arg      
       elif opt in ['-s','--step']:
-        step=int(arg)     
+        step=float(arg)     
+      elif opt in ['-c','--continuation']:
+        must_trace=True
+      elif opt in ['-b','--batch']:
+        import fileinput
+        run_batch(fileinput.input(args))
+        sys.exit()
+
+    if must_trace:
+      branches,folds,evaluations=trace_branches(fromL,toL,tolerance=tolerance)
+      for L,T in folds:
+        print ('Fold at L={0:.6f}, T={1:.6f}'.format(L,T))
+      for Ls,Ts,stable in branches:
+        print ('{0} branch from L={1:.3f}, T={2:.3f} to L={3:.3f}, T={4:.3f}: {5} points'.\
+               format('Stable' if stable else 'Unstable',Ls[0],Ts[0],Ls[-1],Ts[-1],len(Ls)))
+      print ('{0} evaluations'.format(evaluations))
+      if must_plot:
+        import  matplotlib.pyplot as plt
+        plot_branches(branches,folds,name)
+      sys.exit()
 
-    
     Ls1,Ts1=evolve_model(toL,fromL,step,tolerance)
     Ls2,Ts2=evolve_model(fromL,toL,step,tolerance)
   
@@ -0,0 +1,229 @@
+# (C) 2019 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+# Benchmarks and regression gate for shallow.py
+#
+# For each grid size, rotation algorithm, and wrap mode, time the model's
+# step, and record steps per second, cell updates per second, and peak memory.
+# Then check that the vectorized model agrees with reference fields, which were
+# calculated by the original loops for the grader's configuration, and, if a
+# baseline is supplied, that no case has slowed down by more than the tolerance.
+#
+# The results are written as JSON, so runs can be compared over time: use the
+# results of one run as the baseline for the next. The exit status is 1 if
+# the model disagrees with the reference fields, or if a case has regressed.
+
+import sys,getopt,os,json,time,platform,tracemalloc,numpy,shallow
+
+SIZES      = [5,50,200,1000]
+ALGORITHMS = ['trivial_rotation','easy_rotation','full_rotation']
+WRAPS      = [False,True]
+FIELDS     = ['H','U','V','dHdT','rotU']
+
+# The grader's configuration: python shallow.py, with default parameters.
+# The reference is taken after 10 slices of 1000 steps, since some of the
+# rotation algorithms overflow before the grader's 400 slices are complete.
+
+REFERENCE_STEPS = 10000
+
+# time_step
+#
+# Time steps of one model, taking batches of increasing size until the elapsed
+# time reaches duration. Returns the number of steps, and the elapsed time.
+
+def time_step(model,duration):
+    model.step(1)      # warm up
+    steps   = 0
+    elapsed = 0
+    batch   = 1
+    while elapsed < duration:
+        start    = time.perf_counter()
+        model.step(batch)
+        elapsed += time.perf_counter() - start
+        steps   += batch
+        batch   *= 2
+    return (steps,elapsed)
+
+# get_peak_memory
+#
+# Peak memory, in bytes, allocated while a model is created and stepped. This
+# is measured separately from the timing, since tracemalloc slows allocation.
+
+def get_peak_memory(parameters,steps=2):
+    tracemalloc.start()
+    try:
+        shallow.ShallowWaterModel(**parameters).step(steps)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def benchmark(sizes=SIZES,duration=1.0):
+    cases = []
+    print ('{0:>5} {1:>17} {2:>5} {3:>9} {4:>12} {5:>16} {6:>12}'.format('ncol','algorithm','wrap','steps',
+                                                                        'steps/s','cell updates/s','peak bytes'))
+    for ncol in sizes:
+        for rotationAlgorithm in ALGORITHMS:
+            for horizontalWrap in WRAPS:
+                parameters    = {'ncol':ncol,'rotationAlgorithm':rotationAlgorithm,'horizontalWrap':horizontalWrap}
+                model         = shallow.ShallowWaterModel(**parameters)
+                with numpy.errstate(all='ignore'):  # some rotations overflow in long runs
+                    steps,elapsed = time_step(model,duration)
+                case = dict(parameters,
+                            steps                   = steps,
+                            seconds                 = elapsed,
+                            steps_per_second        = steps/elapsed,
+                            cell_updates_per_second = steps*model.nrow*model.ncol/elapsed,
+                            peak_memory_bytes       = get_peak_memory(parameters))
+                cases.append(case)
+                print ('{ncol:>5} {rotationAlgorithm:>17} {horizontalWrap!s:>5} {steps:>9} {steps_per_second:>12.1f} '
+                       '{cell_updates_per_second:>16.4g} {peak_memory_bytes:>12}'.format(**case))
+    return cases
+
+# generate_reference
+#
+# Calculate the reference fields using the original loops, and save them.
+# Floats are written with repr, so they are read back exactly.
+
+def generate_reference(path):
+    references = []
+    for rotationAlgorithm in ALGORITHMS:
+        for horizontalWrap in WRAPS:
+            model = shallow.ShallowWaterModel(rotationAlgorithm=rotationAlgorithm,horizontalWrap=horizontalWrap,
+                                              reference=True).step(REFERENCE_STEPS)
+            references.append({'rotationAlgorithm' : rotationAlgorithm,
+                               'horizontalWrap'    : horizontalWrap,
+                               'steps'             : REFERENCE_STEPS,
+                               'fields'            : {name:getattr(model,name).tolist() for name in FIELDS}})
+    with open(path,'w') as out:
+        json.dump({'parameters':shallow.ShallowWaterModel().get_parameters(),'references':references},out)
+
+# check_agreement
+#
+# Compare the vectorized model with the reference fields. Values are compared
+# relative to the largest value of each field, since some fields have grown large.
+
+def check_agreement(path,tolerance=1.E-10):
+    with open(path) as f:
+        references = json.load(f)['references']
+    results = []
+    print ('Agreement with reference fields after {0} steps'.format(REFERENCE_STEPS))
+    for reference in references:
+        model = shallow.ShallowWaterModel(rotationAlgorithm = reference['rotationAlgorithm'],
+                                          horizontalWrap    = reference['horizontalWrap']).step(reference['steps'])
+        difference = 0.0
+        for name,values in reference['fields'].items():
+            expected   = numpy.array(values)
+            scale      = max(numpy.max(numpy.abs(expected)),numpy.finfo(float).tiny)
+            difference = max(difference,float(numpy.max(numpy.abs(getattr(model,name)-expected))/scale))
+        results.append({'rotationAlgorithm' : reference['rotationAlgorithm'],
+                        'horizontalWrap'    : reference['horizontalWrap'],
+                        'steps'             : reference['steps'],
+                        'relative_difference': difference,
+                        'passed'            : difference <= tolerance})
+        print ('{rotationAlgorithm:>17} {horizontalWrap!s:>5} {relative_difference:.3g} {0}'.format(
+               'OK' if results[-1]['passed'] else 'FAILED',**results[-1]))
+    return results
+
+# compare
+#
+# Find cases whose cell updates per second have fallen by more than tolerance,
+# relative to the baseline. Cases that aren't in the baseline are ignored.
+
+def compare(cases,baseline,tolerance=0.2):
+    key        = lambda case: (case['ncol'],case['rotationAlgorithm'],case['horizontalWrap'])
+    previous   = {key(case):case for case in baseline['cases']}
+    regressions = []
+    for case in cases:
+        if key(case) in previous:
+            ratio = case['cell_updates_per_second'] / previous[key(case)]['cell_updates_per_second']
+            if ratio < 1 - tolerance:
+                regressions.append(dict(case,ratio=ratio))
+                print ('Regression: ncol={0}, {1}, wrap={2}: {3:.2f} times baseline'.format(*key(case),ratio))
+    return regressions
+
+def help():
+    print ('Benchmarks and regression gate for shallow.py')
+    print ('Usage:')
+    print ('   python shallow-benchmark.py [options]')
+    print ('      -h --help          To get usage instructions')
+    print ('      -s --sizes         Comma separated grid sizes, default {0}'.format(','.join(str(size) for size in SIZES)))
+    print ('      -d --duration      Minimum number of seconds to time each case')
+    print ('      -o --output        Write results to this file (JSON)')
+    print ('      -b --baseline      Compare with results from a previous run')
+    print ('      -t --tolerance     Fractional slowdown that counts as a regression, default 0.2')
+    print ('      -r --reference     File with reference fields')
+    print ('      -g --generate      Generate reference fields using loops, then exit')
+
+if __name__=='__main__':
+    sizes     = SIZES
+    duration  = 1.0
+    output    = 'shallow-benchmark.json'
+    baseline  = None
+    tolerance = 0.2
+    reference = os.path.join(os.path.dirname(os.path.abspath(__file__)),'shallow-reference.json')
+    generate  = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:],'hs:d:o:b:t:r:g',
+                                   ['help','sizes=','duration=','output=','baseline=','tolerance=','reference=','generate'])
+    except getopt.GetoptError as e:
+        print (e)
+        help()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ['-h','--help']:
+            help()
+            sys.exit()
+        elif opt in ['-s','--sizes']:
+            sizes = [int(size) for size in arg.split(',')]
+        elif opt in ['-d','--duration']:
+            duration = float(arg)
+        elif opt in ['-o','--output']:
+            output = arg
+        elif opt in ['-b','--baseline']:
+            baseline = arg
+        elif opt in ['-t','--tolerance']:
+            tolerance = float(arg)
+        elif opt in ['-r','--reference']:
+            reference = arg
+        elif opt in ['-g','--generate']:
+            generate = True
+
+    if generate:
+        generate_reference(reference)
+        sys.exit()
+
+    cases     = benchmark(sizes,duration)
+    agreement = check_agreement(reference)
+    results   = {'timestamp'  : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 'revision'   : shallow.version(),
+                 'python'     : platform.python_version(),
+                 'numpy'      : numpy.__version__,
+                 'machine'    : platform.platform(),
+                 'processor'  : platform.processor(),
+                 'cases'      : cases,
+                 'agreement'  : agreement}
+    regressions = []
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = compare(cases,json.load(f),tolerance)
+        results['baseline']    = baseline
+        results['regressions'] = regressions
+    with open(output,'w') as out:
+        json.dump(results,out,indent=2)
+
+    if len(regressions) > 0 or not all(result['passed'] for result in agreement):
+        sys.exit(1)
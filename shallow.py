@@ -13,7 +13,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this software.  If not, see <http://www.gnu.org/licenses/>
 # https://www.coursera.org/learn/global-warming-model/home/week/4
-# 
+#
 # Based on shallow_template.py
 
 
@@ -24,30 +24,36 @@
 #     ----V(10)-------V(11)--------V(12)----
 #     |           |            |           |
 #   U(10) H(10) U(11) H(11)  U(12) H(12) [U(13)]
-#     |           |            |           |  
+#     |           |            |           |
 #     ----V(20)-------V(21)--------V(22)----
 #     |           |            |           |
 #   U(20) H(20) U(21) H(21)  U(22) H(22) [U(23)]
-#     |           |            |           |  
+#     |           |            |           |
 #     ---[V(30)]-----[V(31)]------[V(32)]---
 
 
-import numpy,math,matplotlib.pyplot as plt, matplotlib.ticker as tkr
+import sys,getopt,os,re,json,tempfile,functools,threading,queue,time,multiprocessing,traceback,numpy,math
 
-# First we have some functions that implement rotation calculations
+# matplotlib is slow to import, so it is imported by the functions that plot
+
+# First we have some functions that implement rotation calculations. These loop
+# over the grid, and are used by ShallowWaterModel.loop_step, which is retained
+# as a reference. All three have the same signature, so they are interchangeable.
 
 # Easier First Method: Loop over all rows and columns, and calculate
 
 # rotU[irow,icol] = rotConst[irow] * U[irow,icol]
 
-def easy_rotation():
+def easy_rotation(U,V,rotU,rotV,rotConst):
+  nrow,ncol = rotU.shape
   for i in range(nrow):
-    for j in range(ncol):    
+    for j in range(ncol):
       rotU[i,j] = rotConst[i] * U[i,j]
       rotV[i,j] = -rotConst[i] * V[i,j]
 
 # Interpolated rotation
-def full_rotation():
+def full_rotation(U,V,rotU,rotV,rotConst):
+  nrow,ncol = rotU.shape
   # interpolate the U and V values onto the cell centers.
   U_centre = numpy.zeros((nrow, ncol+1)) # Temporary - TODO just do this once when we initialize
   V_centre = numpy.zeros((nrow, ncol+1)) # Temporary - TODO just do this once when we initialize
@@ -55,51 +61,282 @@ def full_rotation():
     for j in range(ncol):
       U_centre[i,j] = 0.5 *(U[i,j]+U[i,j+1])
       V_centre[i,j] = 0.5 *(V[i,j]+V[i+1,j])
-      
+
 # calculate the rotational transformation of U and V as gridded
-# on the H points, by multiplying each array by rotConst[]. 
+# on the H points, by multiplying each array by rotConst[].
+  # rotV_centre has an extra row, so the southernmost V can be back-interpolated
+  # from the wall, where V is always zero.
   rotU_centre = numpy.zeros((nrow, ncol+1)) # Temporary - TODO just do this once when we initialize
-  rotV_centre = numpy.zeros((nrow, ncol+1)) # Temporary - TODO just do this once when we initialize
+  rotV_centre = numpy.zeros((nrow+1, ncol+1)) # Temporary - TODO just do this once when we initialize
   for i in range(nrow):
-    for j in range(ncol):    
+    for j in range(ncol):
       rotU_centre [i,j] = rotConst[i] * U_centre[i,j]
       rotV_centre [i,j] = -rotConst[i] * V_centre[i,j]
-      
+
 # Finally, the rotated velocities, placed at the cell centers,
 # need to be back-interpolated to the grid locations where the
-# velocities are. 
+# velocities are.
   for i in range(nrow):
     for j in range(ncol):
       rotU[i,j] = 0.5 *(rotU_centre[i,j]+rotU_centre[i,j+1])
-      rotV[i,j] = 0.5 *(rotV_centre[i,j]+rotV_centre[i+1,j])  
-      
+      rotV[i,j] = 0.5 *(rotV_centre[i,j]+rotV_centre[i+1,j])
+
 
 # This is the rotation calculator to use if we want to ignore rotation altogether
 
-def trivial_rotation():
+def trivial_rotation(U,V,rotU,rotV,rotConst):
   pass
 
-"""
-This is the work-horse subroutine.  It steps forward in time, taking ntAnim steps of
-duration dT.  
-"""
+# Rotation
+#
+# The rotation calculations above loop over the grid, and full_rotation allocates
+# its work space every time it is called. This class provides the same three
+# calculations for use with vector_step. It is bound to U, V, rotU, and rotV
+# when it is created, and the cell centre arrays are allocated once, then
+# updated in place, so calculating rotation doesn't allocate any memory during
+# the time loop. The rotation constant is stored as a column, so it broadcasts
+# across each row. The arrays may have a leading axis for the members of an
+# ensemble, in which case each member has its own column of rotation constants.
 
-def animStep(calculate_rotation=trivial_rotation):    
+class Rotation:
+    def __init__(self,U,V,rotU,rotV,rotConst):
+        members            = rotU.shape[:-2]    # Leading axis, if any, is for members of an ensemble
+        nrow,ncol          = rotU.shape[-2:]
+        self.U             = U
+        self.V             = V
+        self.rotU          = rotU
+        self.rotV          = rotV
+        self.rotConst      = numpy.reshape(numpy.array(rotConst,dtype=float),members + (nrow,1))
+        self.minusRotConst = -self.rotConst
+        self.U_centre      = numpy.zeros(members + (nrow, ncol))
+        self.V_centre      = numpy.zeros(members + (nrow, ncol))
+        self.rotU_centre   = numpy.zeros(members + (nrow, ncol+1))     # Column ncol is always zero
+        self.rotV_centre   = numpy.zeros(members + (nrow+1, ncol))     # Row nrow is always zero - it is the wall
+
+    # Create a rotation calculator from its name, e.g. 'full_rotation'
+
+    def get(self,name):
+        return getattr(self,name)
+
+    def easy_rotation(self):
+        ncol = self.rotU.shape[-1]
+        numpy.multiply(self.rotConst,self.U[...,0:ncol],out=self.rotU)
+        numpy.multiply(self.minusRotConst,self.V[...,0:-1,:],out=self.rotV)
+
+    def full_rotation(self):
+        ncol = self.rotU.shape[-1]
+        # interpolate the U and V values onto the cell centers.
+        numpy.add(self.U[...,0:ncol],self.U[...,1:],out=self.U_centre)
+        numpy.multiply(0.5,self.U_centre,out=self.U_centre)
+        numpy.add(self.V[...,0:-1,:],self.V[...,1:,:],out=self.V_centre)
+        numpy.multiply(0.5,self.V_centre,out=self.V_centre)
+        # rotate
+        numpy.multiply(self.rotConst,self.U_centre,out=self.rotU_centre[...,0:ncol])
+        numpy.multiply(self.minusRotConst,self.V_centre,out=self.rotV_centre[...,0:-1,:])
+        # back-interpolate to the grid locations where the velocities are
+        numpy.add(self.rotU_centre[...,0:ncol],self.rotU_centre[...,1:],out=self.rotU)
+        numpy.multiply(0.5,self.rotU,out=self.rotU)
+        numpy.add(self.rotV_centre[...,0:-1,:],self.rotV_centre[...,1:,:],out=self.rotV)
+        numpy.multiply(0.5,self.rotV,out=self.rotV)
+
+    def trivial_rotation(self):
+        pass
+
+def createRotation(nrow,rotationScheme,meanLatitude=30,dxDegrees=10.0E3/110.e3):
+    latitude = []
+    rotConst = []
+
+    for irow in range(0,nrow):
+      if rotationScheme == "WithLatitude":
+        latitude.append( meanLatitude + (irow - nrow/2) * dxDegrees )
+        rotConst.append( -7.e-5 * math.sin(math.radians(latitude[-1]))) # s-1
+      elif rotationScheme == "PlusMinus":
+        rotConst.append( -3.5e-5 * (1. - 0.8 * ( irow - (nrow-1)/2 ) / nrow )) # rot 50% +-
+      elif rotationScheme == "Uniform":
+        rotConst.append( -3.5e-5 )
+      else:
+        rotConst.append( 0 )
+    return (latitude,rotConst)
+
+def createWind(nrow,windScheme):
+    windU = []
+    for irow in range(0,nrow):
+        if windScheme == "Curled":
+            windU.append( 1e-8 * math.sin( (irow+0.5)/nrow * 2 * 3.14 ) )
+        elif windScheme == "Uniform":
+            windU.append( 1.e-8 )
+        else:
+            windU.append( 0 )
+    return windU
+
+# allocate
+#
+# Allocate a single contiguous block of memory, and partition it into
+# arrays of the specified shapes. Returns the block and a list of the arrays,
+# which are views into the block. The block may be supplied as a buffer, e.g.
+# a multiprocessing.RawArray, so the arrays can be shared between processes.
+
+def allocate(shapes,buffer=None):
+    sizes  = [int(numpy.prod(shape)) for shape in shapes]
+    block  = numpy.zeros(sum(sizes)) if buffer is None else numpy.frombuffer(buffer)[0:sum(sizes)]
+    arrays = []
+    start  = 0
+    for shape,size in zip(shapes,sizes):
+        arrays.append(block[start:start+size].reshape(shape))
+        start += size
+    return (block,arrays)
+
+# ShallowWaterModel
+#
+# This class holds the state of the model, so it can be imported, and so
+# more than one model can be run in the same process. The prognostic fields
+# U, V, and H share one block of memory, and the derivatives and intermediate
+# values share another, so the state can be saved or copied as a single array.
+#
+# Create a model, then use step(n) to advance it by n time steps of duration dT.
+
+class ShallowWaterModel:
+    def __init__(self,
+                 ncol                = 5,                  # grid size (number of cells)
+                 nrow                = None,               # defaults to ncol
+                 horizontalWrap      = False,              # determines whether the flow wraps around
+                 rotationScheme      = 'PlusMinus',        # "WithLatitude", "PlusMinus", "Uniform"
+                 windScheme          = 'Curled',           # "Curled", "Uniform"
+                 initialPerturbation = '',                 # "Tower", "NSGradient", "EWGradient"
+                 rotationAlgorithm   = 'trivial_rotation', # "trivial_rotation", "easy_rotation", "full_rotation"
+                 reference           = False,              # Use loop_step instead of vector_step
+                 integrator          = 'euler',            # "euler", "forward_backward", "leapfrog", "rk3", "semi_implicit"
+                 dT                  = 600,                # seconds
+                 G                   = 9.8e-4,             # m/s2, hacked (low-G) to make it run faster
+                 HBackground         = 4000,               # meters
+                 dX                  = 10.0E3,             # meters
+                 dY                  = None,               # defaults to dX
+                 dragConst           = 1.E-6,              # about 10 days decay time
+                 meanLatitude        = 30):                # degrees
+        self.ncol                = ncol
+        self.nrow                = ncol if nrow is None else nrow
+        self.horizontalWrap      = horizontalWrap
+        self.rotationScheme      = rotationScheme
+        self.windScheme          = windScheme
+        self.initialPerturbation = initialPerturbation
+        self.rotationAlgorithm   = rotationAlgorithm
+        self.reference           = reference
+        self.integratorName      = integrator
+        self.dT                  = dT
+        self.G                   = G
+        self.HBackground         = HBackground
+        self.dX                  = dX
+        self.dY                  = dX if dY is None else dY
+        self.dxDegrees           = self.dX / 110.e3
+        self.dyDegrees           = self.dY / 110.e3
+        self.flowConst           = G  # 1/s2
+        self.dragConst           = dragConst
+        self.meanLatitude        = meanLatitude
+        self.itGlobal            = 0
+        self.time                = 0.0      # seconds since start of run; dT may vary
+        self.profiler            = None     # see profile()
+        self.diagnostics         = None     # see Diagnostics
+
+        nrow,ncol = self.nrow,self.ncol
+        self.latitude,self.rotConst = createRotation(nrow,rotationScheme,meanLatitude,self.dxDegrees)
+        self.windU                  = createWind(nrow,windScheme)
+        self.windColumn             = numpy.reshape(numpy.array(self.windU,dtype=float),(nrow,1))
+
+        self.state,(self.U,self.V,self.H) = allocate([(nrow, ncol+1),(nrow+1, ncol),(nrow, ncol+1)])
+        self.scratch,(self.dHdX,self.dUdX,self.dHdY,self.dVdY,
+                      self.rotU,            # interpolated to v locations
+                      self.rotV,            # interpolated to u locations
+                      self.dUdT,self.dVdT,self.dHdT,
+                      self.work) = allocate([(nrow, ncol+1)] + 9*[(nrow, ncol)])
+
+        self.perturb(initialPerturbation)
+
+        self.integrator = INTEGRATORS[integrator](self)
+        if reference:
+            if integrator != 'euler':
+                raise ValueError('The reference implementation only supports the euler integrator')
+            self.kernel             = self.loop_step
+            self.calculate_rotation = functools.partial(globals()[rotationAlgorithm],
+                                                        self.U,self.V,self.rotU,self.rotV,self.rotConst)
+        else:
+            self.kernel             = self.integrator.step
+            self.rotation           = Rotation(self.U,self.V,self.rotU,self.rotV,self.rotConst)
+            self.calculate_rotation = self.rotation.get(rotationAlgorithm)
+
+    # perturb
+    #
+    # Set initial value of H
+
+    def perturb(self,initialPerturbation):
+        midCell = int(self.ncol/2)
+        if initialPerturbation == "Tower":
+            self.H[midCell,midCell] = 1
+        elif initialPerturbation == "NSGradient":
+            self.H[0:midCell,:] = 0.1
+        elif initialPerturbation == "EWGradient":
+            self.H[:,0:midCell] = 0.1
+
+    """
+    This is the work-horse subroutine.  It steps forward in time, taking n steps of
+    duration dT. The kernel is the step method of the integrator, or loop_step,
+    which is retained as a reference. If diagnostics are attached, the steps are
+    taken in chunks, so the diagnostics can be checked every few steps.
+    """
+
+    def step(self,n=1):
+        if self.diagnostics is None:
+            return self.advance(n)
+        while n > 0:
+            chunk  = self.diagnostics.get_steps(self.itGlobal,n)
+            self.advance(chunk)
+            n     -= chunk
+            if self.itGlobal % self.diagnostics.every == 0:
+                self.diagnostics.check(self)
+        return self
+
+    # advance
+    #
+    # Take n steps, without checking diagnostics
+
+    def advance(self,n):
+        start = time.perf_counter()
+        if self.profiler is None:
+            for it in range(n):
+                self.kernel()
+        else:
+            self.profiler.start()
+            for it in range(n):
+                self.kernel()
+                self.profiler.lap('other')
+        self.integrator.account(n,time.perf_counter()-start,n*self.dT)
+        self.itGlobal += n
+        self.time     += n * self.dT
+        return self
+
+    # loop_step
+    #
+    # Take a single step of duration dT by looping over every cell of the grid.
+    # This is the original formulation of the model: it is slow, but it is easy
+    # to check against the equations, so it is retained as the reference against
+    # which vector_step is tested.
+
+    def loop_step(self):
+        nrow,ncol,dX,dY                       = self.nrow,self.ncol,self.dX,self.dY
+        flowConst,dragConst,HBackground,dT    = self.flowConst,self.dragConst,self.HBackground,self.dT
+        U,V,H,windU                           = self.U,self.V,self.H,self.windU
+        dHdX,dUdX,dHdY,dVdY,rotU,rotV         = self.dHdX,self.dUdX,self.dHdY,self.dVdY,self.rotU,self.rotV
+        dUdT,dVdT,dHdT                        = self.dUdT,self.dVdT,self.dHdT
 
-    global stepDump, itGlobal
-    
-    # Time Loop
-    for it in range(ntAnim):
-    
         # Longitudinal Derivatives
 
         # Calculate dH/dX (variable dHdX), making sure to put the value in each
         # index [irow, icol] so that it applies to the horizontal velocity
         # at that index location (U[irow, icol]).
-       
+   
         for i in range(nrow):
             for j in range(ncol+1):     
                 dHdX[i,j] = (H[i,j]-H[i,j-1])/dX
+        if self.profiler is not None: self.profiler.lap('longitudinal')
 
         # If the variable horizontalWrap is set to True, the flow out the 
         # right-hand side of the domain (U[:,ncol]) will equal the flow in 
@@ -124,7 +361,8 @@ def animStep(calculate_rotation=trivial_rotation):
         for i in range(nrow):
             for j in range(ncol):         
                 dUdX[i,j] = (U[i,j+1]-U[i,j])/dX
- 
+        if self.profiler is not None: self.profiler.lap('longitudinal')
+
         #print ('U')
         #print (U)  
         #print ('H')
@@ -133,28 +371,29 @@ def animStep(calculate_rotation=trivial_rotation):
         #print (dHdX) 
         #print ('dUdX')
         #print (dUdX) 
-        
+    
         # Encode Latitudinal Derivatives Here
-        
+    
         # Within a loop over all grid cells, calculate dHdY, remembering that
         # dHdy[irow, icol] should be comprised of H values that straddle a
         # particular V[irow, icol].
-        
+    
         for i in range(1,nrow):
             for j in range(ncol):
                 dHdY[i,j] = (H[i,j]-H[i-1,j])/dY    #FIXME
-        
+    
                 #The northern and southern boundaries of the domains are always walls.
                 # This means that the flows at the north boundary (V[0,:]), and the
                 # south (a ghost cell would be V[ncol,:]) are both set to zero. Assume
                 # that this will be true going into this loop, and that the ghost cell exists.
-        
+    
                 # The gradient in the surface elevation, dHdY, should be set to zero
                 # at the top boundary. dHdY[0,:] would be used to calculate V[0,:],
                 # which is going to be zero anyway. 
-        
+    
                 dVdY[i,j] = (V[i+1,j]-V[i,j])/dY
-       
+        if self.profiler is not None: self.profiler.lap('latitudinal')
+
         #print ('dHdY')        
         #print (dHdY)
         #print ('V')
@@ -173,7 +412,8 @@ def animStep(calculate_rotation=trivial_rotation):
         # simpler method will generate diagonal "stripes" of water level 
         # (waves) across the grid, as an artifact of its less-accurate method.
 
-        calculate_rotation()
+        self.calculate_rotation()
+        if self.profiler is not None: self.profiler.lap('rotation')
 
         # Assemble the Time Derivatives Here
         # Encode the equations for dU/dT, dV/dT, and dH/dT, given above, by 
@@ -182,12 +422,13 @@ def animStep(calculate_rotation=trivial_rotation):
         # those of the arrays U, V, and H that they are going to update.
         # It's very easy to make a mistake of this type, and the flow results 
         #you get will be strange and non-physical.
-       
+   
         for i in range(nrow):
             for j in range(ncol):
                 dUdT[i,j] = rotU[i,j] - flowConst * dHdX[i,j] - dragConst * U[i,j] + windU[i]
                 dVdT[i,j] = rotV[i,j] - flowConst * dHdY[i,j] - dragConst * V[i,j]
                 dHdT[i,j] = - ( dUdX[i,j] + dVdY[i,j] ) * HBackground / dX
+        if self.profiler is not None: self.profiler.lap('tendencies')
 
         # Step Forward One Time Step
         # Step forward in time by looping over the grid, updating each variable
@@ -197,152 +438,1493 @@ def animStep(calculate_rotation=trivial_rotation):
                 U[i,j]+=(dUdT[i][j]*dT)
                 V[i,j]+=(dVdT[i][j]*dT)
                 H[i,j]+=(dHdT[i][j]*dT)
-                
-        # Update the Boundary and Ghost Cells
-        # At the end of each time step, do any maintenance that needs doing
-        # for the ghost cells, which are cells at the edges that mirror other#
-        # cells in the grid to make it easier to calculate spatial derivatives at the edges.
+        if self.profiler is not None: self.profiler.lap('update')
 
-        #The velocities at the north wall should be zeroed.
+        self.update_ghost_cells()
+
+    # vector_step
+    #
+    # Take a single step of duration dT, using whole array slices instead of loops.
+    # Each element is calculated from the same operands, in the same order, as in
+    # loop_step, so the two give identical values for H, U, and V. NB: as in
+    # loop_step, dHdY and dVdY are not calculated for row 0.
+    # Results are written in place, with the work array holding intermediate
+    # values, so no memory is allocated during the time loop. Use this with the
+    # rotation calculators from the Rotation class. The slices are indexed from the
+    # right, so the same code steps every member of a ShallowWaterEnsemble.
+    # The tendencies are calculated by momentum_tendencies and height_tendency,
+    # which are shared with the other integrators.
+
+    def vector_step(self):
+        ncol,nrow,work = self.ncol,self.nrow,self.work
+        U,V,H          = self.U,self.V,self.H
+
+        self.momentum_tendencies()
+        self.height_tendency()
+
+        # Step Forward One Time Step
+        numpy.multiply(self.dUdT,self.dT,out=work)
+        numpy.add(U[...,0:ncol],work,out=U[...,0:ncol])
+        numpy.multiply(self.dVdT,self.dT,out=work)
+        numpy.add(V[...,0:nrow,:],work,out=V[...,0:nrow,:])
+        numpy.multiply(self.dHdT,self.dT,out=work)
+        numpy.add(H[...,0:ncol],work,out=H[...,0:ncol])
+        if self.profiler is not None: self.profiler.lap('update')
+
+        self.update_ghost_cells()
+
+    # momentum_tendencies
+    #
+    # Calculate dUdT and dVdT from the current state: the gradient of H,
+    # rotation, drag, and wind.
+
+    def momentum_tendencies(self):
+        ncol,nrow        = self.ncol,self.nrow
+        U,V,work         = self.U,self.V,self.work
+        dHdX,dHdY,dUdT,dVdT = self.dHdX,self.dHdY,self.dUdT,self.dVdT
+
+        self.momentum_gradients()
+        self.calculate_rotation()
+        if self.profiler is not None: self.profiler.lap('rotation')
+
+        # Assemble the Time Derivatives, using work for intermediate values
+        numpy.multiply(self.flowConst,dHdX[...,0:ncol],out=work)
+        numpy.subtract(self.rotU,work,out=dUdT)
+        numpy.multiply(self.dragConst,U[...,0:ncol],out=work)
+        numpy.subtract(dUdT,work,out=dUdT)
+        numpy.add(dUdT,self.windColumn,out=dUdT)
+
+        numpy.multiply(self.flowConst,dHdY,out=work)
+        numpy.subtract(self.rotV,work,out=dVdT)
+        numpy.multiply(self.dragConst,V[...,0:nrow,:],out=work)
+        numpy.subtract(dVdT,work,out=dVdT)
+        if self.profiler is not None: self.profiler.lap('tendencies')
+
+    # momentum_gradients
+    #
+    # Calculate the gradient of H, which drives U and V
+
+    def momentum_gradients(self):
+        ncol,dX,dY = self.ncol,self.dX,self.dY
+        H          = self.H
+        dHdX,dHdY  = self.dHdX,self.dHdY
+
+        # Longitudinal Derivative. Column 0 of dHdX uses H[:,-1], i.e. the ghost column
+        numpy.subtract(H[...,1:],H[...,0:ncol],out=dHdX[...,1:])
+        numpy.subtract(H[...,0],H[...,ncol],out=dHdX[...,0])
+        numpy.divide(dHdX,dX,out=dHdX)
+        if self.profiler is not None: self.profiler.lap('longitudinal')
+
+        # Latitudinal Derivative
+        numpy.subtract(H[...,1:,0:ncol],H[...,0:-1,0:ncol],out=dHdY[...,1:,:])
+        numpy.divide(dHdY[...,1:,:],dY,out=dHdY[...,1:,:])
+        if self.profiler is not None: self.profiler.lap('latitudinal')
 
-        if horizontalWrap:
-            # If the horizontal flow wraps around the grid (meaning: you should 
-            # write to code to see if the variable horizontalWrap is set to a 
+    # height_tendency
+    #
+    # Calculate dHdT from the divergence of the current flow
+
+    def height_tendency(self):
+        ncol,dX,dY      = self.ncol,self.dX,self.dY
+        U,V             = self.U,self.V
+        dUdX,dVdY,dHdT  = self.dUdX,self.dVdY,self.dHdT
+
+        numpy.subtract(U[...,1:],U[...,0:ncol],out=dUdX)
+        numpy.divide(dUdX,dX,out=dUdX)
+        if self.profiler is not None: self.profiler.lap('longitudinal')
+        numpy.subtract(V[...,2:,:],V[...,1:-1,:],out=dVdY[...,1:,:])
+        numpy.divide(dVdY[...,1:,:],dY,out=dVdY[...,1:,:])
+        if self.profiler is not None: self.profiler.lap('latitudinal')
+
+        numpy.add(dUdX,dVdY,out=dHdT)
+        numpy.negative(dHdT,out=dHdT)
+        numpy.multiply(dHdT,self.HBackground,out=dHdT)
+        numpy.divide(dHdT,dX,out=dHdT)
+        if self.profiler is not None: self.profiler.lap('tendencies')
+
+    # update_ghost_cells
+    #
+    # Update the Boundary and Ghost Cells
+    # At the end of each time step, do any maintenance that needs doing
+    # for the ghost cells, which are cells at the edges that mirror other
+    # cells in the grid to make it easier to calculate spatial derivatives at the edges.
+
+    def update_ghost_cells(self):
+        #The velocities at the north wall should be zeroed.
+        ncol = self.ncol
+        if self.horizontalWrap:
+            # If the horizontal flow wraps around the grid (meaning: you should
+            # write to code to see if the variable horizontalWrap is set to a
             # value of True, and if it is), set the ghost cells for U and H, for
-            # indices [:, ncol], to equal their values at indices[:,0]. 
+            # indices [:, ncol], to equal their values at indices[:,0].
             # Your code should calculate new values for U and H in the leftmost
             # grid cell (column 0), while you need to update the ghost cell.
             # This is in column ncols, because the numbering of the columns starts
-            # at 0. Columns numbered 0 to (ncols-1) are in the computational grid, 
-            # and column number ncols is an "extra" ghost cell.            
-            H[:, ncol] =  H[:, 0]
-            U[:, ncol] =  U[:, 0]
+            # at 0. Columns numbered 0 to (ncols-1) are in the computational grid,
+            # and column number ncols is an "extra" ghost cell.
+            self.H[...,ncol] =  self.H[...,0]
+            self.U[...,ncol] =  self.U[...,0]
         else:
             # If the flow doesn't wrap, set U = zero at the eastern and western
             # boundaries (indices [:,0] and [:,ncol]).
-            U[:, 0] =  0
-            U[:, ncol] =  0
+            self.U[...,0] =  0
+            self.U[...,ncol] =  0
+        if self.profiler is not None: self.profiler.lap('ghost')
 
-        
-#   Now you're done
+    # profile
+    #
+    # Start (or, if enabled is False, stop) accumulating the time spent in each
+    # phase of the time step. Returns the Profiler, which keeps its totals if
+    # profiling is stopped and started again.
 
-    itGlobal = itGlobal + ntAnim
+    def profile(self,enabled=True):
+        profiler      = Profiler() if self.profiler is None else self.profiler
+        self.profiler = profiler if enabled else None
+        return profiler
 
-def createRotation(nrow,rotationScheme):   
-    latitude = []
-    rotConst = []
+    # Time in days since start of run
 
-    for irow in range(0,nrow):
-      if rotationScheme == "WithLatitude":
-        latitude.append( meanLatitude + (irow - nrow/2) * dxDegrees )
-        rotConst.append( -7.e-5 * math.sin(math.radians(latitude[-1]))) # s-1
-      elif rotationScheme == "PlusMinus":
-        rotConst.append( -3.5e-5 * (1. - 0.8 * ( irow - (nrow-1)/2 ) / nrow )) # rot 50% +-
-      elif rotationScheme == "Uniform":
-        rotConst.append( -3.5e-5 ) 
-      else:
-        rotConst.append( 0 )
-    return (latitude,rotConst)
+    def get_days(self):
+        return self.time / 86400.
 
-def createWind(nrow,windScheme):    
-    windU = []
-    for irow in range(0,nrow):
-        if windScheme == "Curled":
-            windU.append( 1e-8 * math.sin( (irow+0.5)/nrow * 2 * 3.14 ) ) 
-        elif windScheme == "Uniform":
-            windU.append( 1.e-8 )
+    # get_parameters
+    #
+    # The arguments needed to construct an identical model
+
+    def get_parameters(self):
+        return {name:getattr(self,name) for name in ['ncol','nrow','horizontalWrap','rotationScheme','windScheme',
+                                                      'initialPerturbation','rotationAlgorithm','reference',
+                                                      'dT','G','HBackground','dX','dY','dragConst','meanLatitude']}|\
+               {'integrator':self.integratorName}
+
+    # save
+    #
+    # Write a checkpoint, from which the model can be restarted using load().
+
+    def save(self,path):
+        write_checkpoint(path,type(self).__name__,self.get_parameters(),self.itGlobal,self.time,self.state,
+                         self.integrator.get_state())
+
+# ShallowWaterEnsemble
+#
+# Many configurations of the model, stepped together. Each member is described by
+# a dictionary of the parameters that may vary between members: rotationScheme,
+# windScheme, initialPerturbation, dragConst, G, and meanLatitude. The remaining
+# parameters, e.g. the grid size and dT, are shared by all members.
+#
+# U, V, H, and the scratch arrays have a leading axis for the members, so U
+# is (N, nrow, ncol+1), and the per member parameters are stored with shapes
+# that broadcast against them, so vector_step advances every member at once.
+# Use members() to get the results for each member as a ShallowWaterModel.
+#
+# Example:
+#    ensemble = ShallowWaterEnsemble([{'dragConst':1.E-6},{'dragConst':2.E-6,'windScheme':'Uniform'}],
+#                                    ncol=10,horizontalWrap=True)
+#    for model in ensemble.step(1000).members():
+#        print (model.H)
+
+class ShallowWaterEnsemble(ShallowWaterModel):
+    def __init__(self,
+                 configurations,                           # list of dictionaries, one for each member
+                 ncol                = 5,
+                 nrow                = None,
+                 horizontalWrap      = False,
+                 rotationAlgorithm   = 'trivial_rotation',
+                 integrator          = 'euler',
+                 dT                  = 600,
+                 HBackground         = 4000,
+                 dX                  = 10.0E3,
+                 dY                  = None):
+        shared         = {'ncol'              : ncol,
+                          'nrow'              : nrow,
+                          'horizontalWrap'    : horizontalWrap,
+                          'rotationAlgorithm' : rotationAlgorithm,
+                          'integrator'        : integrator,
+                          'dT'                : dT,
+                          'HBackground'       : HBackground,
+                          'dX'                : dX,
+                          'dY'                : dY}
+        self.configurations = [dict(configuration) for configuration in configurations]
+        self.models    = [ShallowWaterModel(**shared,**configuration) for configuration in configurations]
+        first          = self.models[0]
+        N              = len(self.models)
+
+        self.ncol              = first.ncol
+        self.nrow              = first.nrow
+        self.horizontalWrap    = horizontalWrap
+        self.rotationAlgorithm = rotationAlgorithm
+        self.reference         = False
+        self.integratorName    = integrator
+        self.dT                = dT
+        self.HBackground       = HBackground
+        self.dX                = first.dX
+        self.dY                = first.dY
+        self.itGlobal          = 0
+        self.time              = 0.0
+        self.profiler          = None
+        self.diagnostics       = None
+
+        nrow,ncol = self.nrow,self.ncol
+        self.rotConst   = numpy.array([model.rotConst for model in self.models],dtype=float).reshape(N,nrow,1)
+        self.windColumn = numpy.array([model.windColumn for model in self.models])
+        self.flowConst  = numpy.array([model.flowConst for model in self.models],dtype=float).reshape(N,1,1)
+        self.dragConst  = numpy.array([model.dragConst for model in self.models],dtype=float).reshape(N,1,1)
+
+        self.state,(self.U,self.V,self.H) = allocate([(N,nrow, ncol+1),(N,nrow+1, ncol),(N,nrow, ncol+1)])
+        self.scratch,(self.dHdX,self.dUdX,self.dHdY,self.dVdY,
+                      self.rotU,self.rotV,
+                      self.dUdT,self.dVdT,self.dHdT,
+                      self.work) = allocate([(N,nrow, ncol+1)] + 9*[(N,nrow, ncol)])
+        for i,model in enumerate(self.models):
+            self.H[i] = model.H
+
+        self.integrator         = INTEGRATORS[integrator](self)
+        self.kernel             = self.integrator.step
+        self.rotation           = Rotation(self.U,self.V,self.rotU,self.rotV,self.rotConst)
+        self.calculate_rotation = self.rotation.get(rotationAlgorithm)
+
+    def __len__(self):
+        return len(self.models)
+
+    def get_parameters(self):
+        parameters = {name:getattr(self,name) for name in ['ncol','nrow','horizontalWrap','rotationAlgorithm',
+                                                           'dT','HBackground','dX','dY']}
+        parameters['integrator']     = self.integratorName
+        parameters['configurations'] = self.configurations
+        return parameters
+
+    # members
+    #
+    # Copy the state of the ensemble to the models representing each member,
+    # and return the list of models, so each member can be inspected as if
+    # it was a single run.
+
+    def members(self):
+        for i,model in enumerate(self.models):
+            for name in ['U','V','H','dHdX','dUdX','dHdY','dVdY','rotU','rotV','dUdT','dVdT','dHdT']:
+                getattr(model,name)[...] = getattr(self,name)[i]
+            model.itGlobal = self.itGlobal
+            model.time     = self.time
+            model.dT       = self.dT
+        return self.models
+
+# Profiler
+#
+# Accumulates the time spent in each phase of the time step, and the number of
+# times each phase is executed. The kernels call lap(phase) at the end of each
+# phase, which charges the time since the previous lap to that phase; if the
+# profiler is switched off, this costs one test of model.profiler per phase.
+# Time that isn't charged to any phase, e.g. the loop in step(), is charged
+# to 'other' at the end of each step, so calls['other'] is the number of steps.
+
+class Profiler:
+    PHASES = ['longitudinal',   # derivatives: dHdX and dUdX
+              'latitudinal',    # derivatives: dHdY and dVdY
+              'rotation',
+              'tendencies',     # assembling dUdT, dVdT, and dHdT
+              'update',         # Euler update, or the integrator's equivalent
+              'ghost',          # boundary and ghost cells
+              'other']
+
+    def __init__(self):
+        self.seconds = {phase:0.0 for phase in Profiler.PHASES}
+        self.calls   = {phase:0 for phase in Profiler.PHASES}
+        self.last    = None
+
+    def start(self):
+        self.last = time.perf_counter()
+
+    def lap(self,phase):
+        now                  = time.perf_counter()
+        self.seconds[phase] += now - self.last
+        self.calls[phase]   += 1
+        self.last            = now
+
+    # get_summary
+    #
+    # Returns a list of dictionaries, one for each phase
+
+    def get_summary(self):
+        total = sum(self.seconds.values())
+        return [{'phase'            : phase,
+                 'calls'            : self.calls[phase],
+                 'seconds'          : self.seconds[phase],
+                 'fraction'         : self.seconds[phase]/total if total>0 else 0.0,
+                 'seconds_per_call' : self.seconds[phase]/self.calls[phase] if self.calls[phase]>0 else 0.0}
+                for phase in Profiler.PHASES]
+
+    def report(self,out=sys.stdout):
+        out.write('{0:<14} {1:>10} {2:>10} {3:>8} {4:>12}\n'.format('Phase','Calls','Seconds','Percent','usec/call'))
+        for phase in self.get_summary():
+            out.write('{phase:<14} {calls:>10} {seconds:>10.4f} {0:>8.1f} {1:>12.2f}\n'.format(
+                      100*phase['fraction'],1.E6*phase['seconds_per_call'],**phase))
+
+    # dump
+    #
+    # Save the summary as JSON, with the parameters of the model that was profiled
+
+    def dump(self,path,model=None):
+        with open(path,'w') as out:
+            json.dump({'parameters' : None if model is None else model.get_parameters(),
+                       'steps'      : self.calls['other'],
+                       'cells'      : None if model is None else int(model.H[...,0:model.ncol].size),
+                       'phases'     : self.get_summary()},out,indent=2)
+
+# InstabilityError
+#
+# Raised by Diagnostics when a model has gone unstable
+
+class InstabilityError(RuntimeError):
+    def __init__(self,message,record):
+        super().__init__(message)
+        self.record = record
+
+# Diagnostics
+#
+# Calculates the state of the model every `every` steps, and writes it to a
+# compact log, one line for each check (or, for an ensemble, one for each member):
+#     itGlobal member days mass kinetic potential courant
+# where, per unit area of the grid and unit density,
+#     mass      = sum of H * dX * dY, i.e. the volume displaced from HBackground
+#     kinetic   = sum of HBackground * (U*U + V*V)/2 * dX * dY
+#     potential = sum of flowConst * H*H/2 * dX * dY
+#     courant   = largest (|U|+c)*dT/dX + (|V|+c)*dT/dY, c being the wave speed
+# Ghost cells are excluded. If any value isn't finite, which means that the
+# state contains NaN or Inf, or has overflowed, an InstabilityError is raised.
+# An InstabilityError is also raised if the total energy grows by more than
+# a factor of growth between checks, or exceeds limit. The log may be a file,
+# or a path, which is opened for writing. records holds the values from each check.
+#
+# Example:
+#     model.diagnostics = Diagnostics('run.log',every=100,growth=10)
+
+class Diagnostics:
+    def __init__(self,log=None,every=100,growth=None,limit=None):
+        self.every   = every
+        self.growth  = growth
+        self.limit   = limit
+        self.records = []
+        self.energy  = None     # energy at previous check, for each member
+        self.close_log = isinstance(log,str)
+        self.log     = open(log,'w') if self.close_log else log
+        if self.log is not None:
+            self.log.write('# itGlobal member days mass kinetic potential courant\n')
+
+    # Number of steps, up to n, to take before the next check
+
+    def get_steps(self,itGlobal,n):
+        return min(n,self.every - itGlobal % self.every)
+
+    # calculate
+    #
+    # Returns mass, kinetic energy, potential energy, and Courant number, each of
+    # which is an array with one value for each member, or a scalar for a model.
+
+    def calculate(self,model):
+        ncol,nrow = model.ncol,model.nrow
+        U,V,H     = model.U[...,0:ncol],model.V[...,0:nrow,:],model.H[...,0:ncol]
+        area      = model.dX * model.dY
+        mass      = numpy.sum(H,axis=(-2,-1)) * area
+        flowConst = numpy.reshape(model.flowConst,numpy.shape(mass))
+        c         = numpy.reshape(get_wave_speed(model),numpy.shape(mass))
+        kinetic   = 0.5 * model.HBackground * (numpy.einsum('...ij,...ij->...',U,U) +
+                                               numpy.einsum('...ij,...ij->...',V,V)) * area
+        potential = 0.5 * flowConst * numpy.einsum('...ij,...ij->...',H,H) * area
+        courant   = ((numpy.max(numpy.abs(U),axis=(-2,-1)) + c) * model.dT / model.dX +
+                     (numpy.max(numpy.abs(V),axis=(-2,-1)) + c) * model.dT / model.dY)
+        return (mass,kinetic,potential,courant)
+
+    def check(self,model):
+        values = [numpy.atleast_1d(value) for value in self.calculate(model)]
+        energy = values[1] + values[2]
+        days   = model.get_days()
+        records = [(model.itGlobal,member,days) + tuple(float(value) for value in row)
+                   for member,row in enumerate(zip(*values))]
+        self.records.extend(records)
+        if self.log is not None:
+            for record in records:
+                self.log.write('{0} {1} {2:.6g} {3:.6e} {4:.6e} {5:.6e} {6:.4g}\n'.format(*record))
+            self.log.flush()
+        for member,record in enumerate(records):
+            if not all(math.isfinite(value) for value in record[3:]):
+                raise InstabilityError('Step {0}, member {1}: state is not finite'.format(model.itGlobal,member),record)
+            if self.limit is not None and energy[member] > self.limit:
+                raise InstabilityError('Step {0}, member {1}: energy {2:.3g} exceeds {3:.3g}'.format(
+                                       model.itGlobal,member,energy[member],self.limit),record)
+            if self.growth is not None and self.energy is not None and self.energy[member] > 0 \
+                    and energy[member] > self.growth * self.energy[member]:
+                raise InstabilityError('Step {0}, member {1}: energy grew from {2:.3g} to {3:.3g}'.format(
+                                       model.itGlobal,member,self.energy[member],energy[member]),record)
+        self.energy = energy
+
+    def close(self):
+        if self.close_log:
+            self.log.close()
+
+# Domain decomposition
+#
+# For large grids, the rows are divided into latitude bands, one for each
+# worker process; since rotConst and windU depend only on the row, each band
+# can be stepped by a ShallowWaterModel of its own. The bands are extended by
+# halo rows: one row above, for dHdY and for the V that full_rotation
+# interpolates, and one row below (two rows of V), for dVdY and the back
+# interpolation of rotV. Columns, including the ghost columns used for
+# horizontalWrap, are never split, so update_ghost_cells works unchanged.
+#
+# The halo rows are exchanged through shared memory after every step. Each
+# worker writes the rows its neighbours need into an exchange buffer, waits at a
+# barrier, and reads its own halos back. The exchange alternates between two
+# buffers, so a worker can't overwrite rows that a slower neighbour hasn't read.
+# Values in the halos are recalculated by each band, but discarded, so every
+# cell is calculated from the same values as in a serial run, and the results
+# are identical.
+
+# get_bands
+#
+# Divide nrow rows into n bands of nearly equal size, returned as (start,stop).
+# Each band must have at least two rows, so the halos only come from neighbours.
+
+def get_bands(nrow,n):
+    if n < 1 or 2*n > nrow:
+        raise ValueError('Cannot divide {0} rows into {1} bands of at least two rows'.format(nrow,n))
+    edges = [(nrow*i)//n for i in range(n+1)]
+    return list(zip(edges[:-1],edges[1:]))
+
+# Band
+#
+# The rows stepped by one worker: rows start to stop are owned by the worker,
+# and the model holds rows first to last, including the halos.
+
+class Band:
+    def __init__(self,parameters,rotConst,windColumn,nrow,start,stop):
+        self.nrow        = nrow
+        self.start       = start
+        self.stop        = stop
+        self.first       = max(start-1,0)
+        self.last        = min(stop+1,nrow)
+        self.model       = ShallowWaterModel(**dict(parameters,nrow=self.last-self.first))
+        model            = self.model
+        model.rotConst   = rotConst[self.first:self.last]
+        model.windColumn = windColumn[self.first:self.last]
+        model.rotation   = Rotation(model.U,model.V,model.rotU,model.rotV,model.rotConst)
+        model.calculate_rotation = model.rotation.get(model.rotationAlgorithm)
+
+    # Rows of a global array that are held by the band, and the same rows in
+    # the band's model. V has an extra row, which is a wall for the last band.
+
+    def held(self,name):
+        extra = 1 if name=='V' else 0
+        return (slice(self.first,self.last+extra),slice(0,self.last+extra-self.first))
+
+    def owned(self):
+        return (slice(self.start,self.stop),slice(self.start-self.first,self.stop-self.first))
+
+    # Copy all rows from global arrays
+
+    def read_all(self,state):
+        for name,array in zip(['U','V','H'],state):
+            rows,local = self.held(name)
+            getattr(self.model,name)[local] = array[rows]
+
+    # Copy the rows this band owns to global arrays
+
+    def write_owned(self,names,arrays):
+        rows,local = self.owned()
+        for name,array in zip(names,arrays):
+            array[rows] = getattr(self.model,name)[local]
+
+    # Copy the rows that neighbours need, i.e. the first two, and the last, to exchange buffer
+
+    def send(self,exchange):
+        for rows in [slice(self.start,self.start+2),slice(self.stop-1,self.stop)]:
+            local = slice(rows.start-self.first,rows.stop-self.first)
+            for name,array in zip(['U','V','H'],exchange):
+                array[rows] = getattr(self.model,name)[local]
+
+    # Copy halos from exchange buffer
+
+    def receive(self,exchange):
+        for name,array in zip(['U','V','H'],exchange):
+            extra = 1 if name=='V' else 0
+            for rows in [slice(self.first,self.start),slice(self.stop,self.last+extra)]:
+                getattr(self.model,name)[rows.start-self.first:rows.stop-self.first] = array[rows]
+
+# run_band
+#
+# The main loop of a worker process. Each command is either ('step',n,dT),
+# which reads the band from the shared state, takes n steps, and writes the rows
+# that it owns back to the shared state and scratch arrays, or None, to stop.
+
+def run_band(connection,barrier,buffers,shapes,parameters,rotConst,windColumn,nrow,start,stop):
+    _,state           = allocate(shapes[0],buffers[0])
+    _,scratch         = allocate(shapes[1],buffers[1])
+    exchanges         = [allocate(shapes[0],buffer)[1] for buffer in buffers[2:]]
+    band              = Band(parameters,rotConst,windColumn,nrow,start,stop)
+    scratch_names     = ['dHdX','dUdX','dHdY','dVdY','rotU','rotV','dUdT','dVdT','dHdT']
+    while True:
+        command = connection.recv()
+        if command is None: break
+        try:
+            _,n,band.model.dT = command
+            band.read_all(state)
+            for i in range(n):
+                if i > 0:
+                    exchange = exchanges[i%2]
+                    band.send(exchange)
+                    barrier.wait()
+                    band.receive(exchange)
+                band.model.vector_step()
+            band.write_owned(['U','V','H'],state)
+            band.write_owned(scratch_names,scratch[0:len(scratch_names)])
+            connection.send(None)
+        except Exception:
+            barrier.abort()
+            connection.send(traceback.format_exc())
+
+# DecomposedShallowWaterModel
+#
+# A model that is stepped by worker processes, each of which steps a band of rows.
+# The state and scratch arrays are shared with the workers, so the model can
+# be used in the same way as a ShallowWaterModel, e.g. checkpointed or plotted,
+# between calls to step(). The workers are started by the first call to step(),
+# and stopped by close(). Only the euler integrator is supported, since the other
+# integrators would need an exchange for each stage, or, for semi_implicit, a
+# global solution. The workers aren't profiled.
+#
+# Example:
+#     with DecomposedShallowWaterModel(ncol=1000,processes=4) as model:
+#         model.step(100)
+
+class DecomposedShallowWaterModel(ShallowWaterModel):
+    def __init__(self,processes=2,**kwargs):
+        super().__init__(**kwargs)
+        if self.reference or self.integratorName != 'euler':
+            raise ValueError('Decomposition only supports the vectorized euler integrator')
+        self.processes = processes
+        self.bands     = get_bands(self.nrow,processes)
+        self.workers   = []
+        nrow,ncol      = self.nrow,self.ncol
+        self.shapes    = ([(nrow, ncol+1),(nrow+1, ncol),(nrow, ncol+1)],[(nrow, ncol+1)] + 9*[(nrow, ncol)])
+        self.buffers   = [multiprocessing.RawArray('d',int(sum(numpy.prod(shape) for shape in shapes)))
+                          for shapes in [self.shapes[0],self.shapes[1],self.shapes[0],self.shapes[0]]]
+        state          = self.state
+        self.state,(self.U,self.V,self.H) = allocate(self.shapes[0],self.buffers[0])
+        self.state[...] = state
+        self.scratch,(self.dHdX,self.dUdX,self.dHdY,self.dVdY,
+                      self.rotU,self.rotV,
+                      self.dUdT,self.dVdT,self.dHdT,
+                      self.work) = allocate(self.shapes[1],self.buffers[1])
+        self.rotation           = Rotation(self.U,self.V,self.rotU,self.rotV,self.rotConst)
+        self.calculate_rotation = self.rotation.get(self.rotationAlgorithm)
+
+    def get_parameters(self):
+        return super().get_parameters() | {'processes':self.processes}
+
+    def start(self):
+        self.barrier = multiprocessing.Barrier(self.processes)
+        parameters   = {name:value for name,value in super().get_parameters().items() if name!='nrow'}
+        parameters['initialPerturbation'] = ''   # the state comes from the shared arrays
+        for start,stop in self.bands:
+            connection,child = multiprocessing.Pipe()
+            process          = multiprocessing.Process(target=run_band,
+                                                       args=(child,self.barrier,self.buffers,self.shapes,parameters,
+                                                             self.rotConst,self.windColumn,self.nrow,start,stop),
+                                                       daemon=True)
+            process.start()
+            self.workers.append((process,connection))
+
+    def advance(self,n):
+        if len(self.workers) == 0:
+            self.start()
+        begin = time.perf_counter()
+        for _,connection in self.workers:
+            connection.send(('step',n,self.dT))
+        errors = [error for error in [connection.recv() for _,connection in self.workers] if error is not None]
+        if len(errors) > 0:
+            self.close()
+            raise RuntimeError('Worker failed\n' + errors[0])
+        self.integrator.account(n,time.perf_counter()-begin,n*self.dT)
+        self.itGlobal += n
+        self.time     += n * self.dT
+        return self
+
+    def close(self):
+        for process,connection in self.workers:
+            if process.is_alive():
+                connection.send(None)
+            process.join()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+# scaling_benchmark
+#
+# Strong scaling: the time to take a fixed number of steps on the same grid, as
+# the number of processes increases. Returns a list of (processes, seconds, speedup),
+# where processes==0 is the serial model, and the speedup is relative to it.
+
+def scaling_benchmark(ncol=1000,steps=50,processes=[1,2,4,8],horizontalWrap=True,
+                      rotationAlgorithm='full_rotation',initialPerturbation='Tower'):
+    parameters = {'ncol':ncol,'horizontalWrap':horizontalWrap,'rotationAlgorithm':rotationAlgorithm,
+                  'initialPerturbation':initialPerturbation}
+    serial     = ShallowWaterModel(**parameters)
+    begin      = time.perf_counter()
+    serial.step(steps)
+    baseline   = time.perf_counter() - begin
+    results    = [(0,baseline,1.0)]
+    print ('{0:>9} {1:>10} {2:>8} {3}'.format('Processes','Seconds','Speedup','Identical'))
+    print ('{0:>9} {1:>10.3f} {2:>8.2f}'.format('serial',baseline,1.0))
+    for n in processes:
+        with DecomposedShallowWaterModel(processes=n,**parameters) as model:
+            model.step(1)           # start workers, so start up isn't counted
+            begin   = time.perf_counter()
+            model.step(steps-1)
+            elapsed = (time.perf_counter() - begin) * steps / (steps-1)
+            results.append((n,elapsed,baseline/elapsed))
+            print ('{0:>9} {1:>10.3f} {2:>8.2f} {3}'.format(n,elapsed,baseline/elapsed,
+                                                          numpy.array_equal(model.state,serial.state)))
+    return results
+
+# Stability of the time step
+#
+# Each integrator knows the largest time step for which it is stable, which
+# depends on the frequency of the fastest gravity wave that the grid supports,
+# on drag, and on rotation. As calculated by this model, rotation changes U and V
+# at rate rotConst, so it behaves like drag, rather than like an oscillation.
+#
+# NB: dHdT is scaled by HBackground/dX, so the effective squared wave speed
+# is flowConst*HBackground/dX, rather than G*HBackground.
+
+def get_wave_speed(model):
+    return numpy.sqrt(model.flowConst * model.HBackground / model.dX)
+
+# Highest frequency that the grid supports: the wave with a wavelength of two cells
+
+def get_max_frequency(model):
+    return 2 * get_wave_speed(model) * math.sqrt(1/model.dX**2 + 1/model.dY**2)
+
+# Courant number for the fastest gravity wave: w*dT/2
+
+def get_courant_number(model):
+    return float(numpy.max(get_max_frequency(model) * model.dT / 2))
+
+# Largest rate of change due to drag and rotation
+
+def get_max_rate(model):
+    return numpy.max(numpy.asarray(model.dragConst,dtype=float)) + numpy.max(numpy.abs(model.rotConst))
+
+# get_stable_time_step
+#
+# The largest time step for which the model's integrator is stable.
+# For an ensemble, this is the smallest over all members.
+
+def get_stable_time_step(model):
+    limit = model.integrator.get_stable_time_step()
+    if not limit > 0:
+        raise ValueError('There is no stable time step for {0}'.format(model.integrator.name))
+    return float(limit)
+
+# Integrator
+#
+# Base class for the integrators, which step the model forward in time using
+# the tendencies from ShallowWaterModel.momentum_tendencies and height_tendency.
+# The integrator also keeps track of how many steps it has taken, and how long
+# they took, so integrators can be compared by their cost per simulated day.
+
+class Integrator:
+    name        = 'integrator'
+    evaluations = 1         # Number of times tendencies are calculated for each step
+
+    def __init__(self,model):
+        self.model     = model
+        self.steps     = 0
+        self.elapsed   = 0.0      # wall clock, seconds
+        self.simulated = 0.0      # model time, seconds
+
+    def account(self,steps,elapsed,simulated):
+        self.steps     += steps
+        self.elapsed   += elapsed
+        self.simulated += simulated
+
+    # Any state, other than the model's, that is needed to restart from a checkpoint
+
+    def get_state(self):
+        return None
+
+    def set_state(self,state):
+        pass
+
+    # get_cost
+    #
+    # Returns steps, evaluations of tendencies, and wall clock seconds per simulated day
+
+    def get_cost(self):
+        days = self.simulated / 86400.
+        return (self.steps/days, self.evaluations*self.steps/days, self.elapsed/days)
+
+    def report(self):
+        steps,evaluations,seconds = self.get_cost()
+        print ('{0}: {1:.1f} steps, {2:.1f} evaluations, {3:.3g} seconds per simulated day'.format(
+               self.name,steps,evaluations,seconds))
+
+    # Allocate an array with the same layout as the model's state, and return
+    # it, with views for U, V, and H
+
+    def allocate_state(self):
+        block,(U,V,H) = allocate([self.model.U.shape,self.model.V.shape,self.model.H.shape])
+        return (block,U,V,H)
+
+    # Copy the tendencies into an array with the layout of the state. The ghost
+    # cells, and the wall at V[nrow], are never written, so they remain zero,
+    # provided the array is only used for tendencies.
+
+    def gather_tendencies(self,U,V,H):
+        model = self.model
+        U[...,0:model.ncol]   = model.dUdT
+        V[...,0:model.nrow,:] = model.dVdT
+        H[...,0:model.ncol]   = model.dHdT
+
+# ForwardEuler
+#
+# The original scheme, which updates U, V, and H using the tendencies from the
+# start of the step. It amplifies an undamped wave at every step, whatever the
+# step size, so gravity waves are only stable because of drag. Drag acts on U and V,
+# but not on H, so a wave with angular frequency w decays at rate dragConst/2,
+# and forward Euler is stable if dT < dragConst/(w*w). This is much more
+# restrictive than the usual CFL condition, w*dT < 2.
+
+class ForwardEuler(Integrator):
+    name = 'euler'
+
+    def step(self):
+        self.model.vector_step()
+
+    def get_stable_time_step(self):
+        r = numpy.asarray(self.model.dragConst,dtype=float)
+        w = get_max_frequency(self.model)
+        return min(numpy.min(r/(w*w)),2/get_max_rate(self.model))
+
+# ForwardBackward
+#
+# Update U and V using forward Euler, then update H using the divergence of the
+# new velocities. The gravity waves are neutral if w*dT < 2, so no drag is needed.
+
+class ForwardBackward(Integrator):
+    name = 'forward_backward'
+
+    def step(self):
+        model,ncol,nrow,work = self.model,self.model.ncol,self.model.nrow,self.model.work
+        model.momentum_tendencies()
+        numpy.multiply(model.dUdT,model.dT,out=work)
+        numpy.add(model.U[...,0:ncol],work,out=model.U[...,0:ncol])
+        numpy.multiply(model.dVdT,model.dT,out=work)
+        numpy.add(model.V[...,0:nrow,:],work,out=model.V[...,0:nrow,:])
+        if model.profiler is not None: model.profiler.lap('update')
+        model.update_ghost_cells()
+        model.height_tendency()
+        numpy.multiply(model.dHdT,model.dT,out=work)
+        numpy.add(model.H[...,0:ncol],work,out=model.H[...,0:ncol])
+        if model.profiler is not None: model.profiler.lap('update')
+        model.update_ghost_cells()
+
+    def get_stable_time_step(self):
+        return min(numpy.min(2/get_max_frequency(self.model)),2/get_max_rate(self.model))
+
+# Leapfrog
+#
+# Step from the previous state, using the tendencies at the current state,
+# which is then smoothed using the Robert-Asselin filter to suppress the
+# computational mode:
+#     new      = previous + 2*dT*tendencies(current)
+#     current += nu * (previous - 2*current + new)
+# The first step, which has no previous state, is forward Euler. Gravity
+# waves are neutral if w*dT < 1.
+
+class Leapfrog(Integrator):
+    name = 'leapfrog'
+
+    def __init__(self,model,nu=0.1):
+        super().__init__(model)
+        self.nu                                         = nu
+        self.started                                    = False
+        self.previous,_,_,_                             = self.allocate_state()
+        self.new,_,_,_                                  = self.allocate_state()
+        self.tendencies,self.tU,self.tV,self.tH         = self.allocate_state()
+
+    def step(self):
+        model,state,previous,new = self.model,self.model.state,self.previous,self.new
+        if not self.started:
+            previous[...] = state
+            model.vector_step()
+            self.started  = True
+            return
+        model.momentum_tendencies()
+        model.height_tendency()
+        self.gather_tendencies(self.tU,self.tV,self.tH)
+        numpy.multiply(self.tendencies,2*model.dT,out=new)
+        numpy.add(previous,new,out=new)
+        # Filter current state, and store it as previous
+        numpy.add(previous,new,out=previous)
+        numpy.subtract(previous,state,out=previous)
+        numpy.subtract(previous,state,out=previous)
+        numpy.multiply(previous,self.nu,out=previous)
+        numpy.add(previous,state,out=previous)
+        state[...] = new
+        if model.profiler is not None: model.profiler.lap('update')
+        model.update_ghost_cells()
+
+    def get_state(self):
+        return self.previous if self.started else None
+
+    def set_state(self,state):
+        self.previous[...] = state
+        self.started       = True
+
+    def get_stable_time_step(self):
+        return min(numpy.min(1/get_max_frequency(self.model)),1/get_max_rate(self.model))
+
+# RungeKutta3
+#
+# The three stage, strong stability preserving, Runge-Kutta scheme of Shu and Osher.
+#     u1 = u0 + dT*F(u0)
+#     u2 = 3/4*u0 + 1/4*(u1 + dT*F(u1))
+#     u3 = 1/3*u0 + 2/3*(u2 + dT*F(u2))
+# Gravity waves are stable if w*dT < sqrt(3).
+
+class RungeKutta3(Integrator):
+    name        = 'rk3'
+    evaluations = 3
+
+    def __init__(self,model):
+        super().__init__(model)
+        self.initial,_,_,_                      = self.allocate_state()
+        self.increment,_,_,_                    = self.allocate_state()
+        self.tendencies,self.tU,self.tV,self.tH = self.allocate_state()
+
+    # Advance model by one Euler step, in place
+
+    def euler(self):
+        model = self.model
+        model.momentum_tendencies()
+        model.height_tendency()
+        self.gather_tendencies(self.tU,self.tV,self.tH)
+        numpy.multiply(self.tendencies,model.dT,out=self.increment)
+        numpy.add(model.state,self.increment,out=model.state)
+        if model.profiler is not None: model.profiler.lap('update')
+        model.update_ghost_cells()
+
+    # Replace state by weight*initial + (1-weight)*state
+
+    def combine(self,weight):
+        state = self.model.state
+        numpy.multiply(state,1-weight,out=state)
+        numpy.multiply(self.initial,weight,out=self.increment)
+        numpy.add(state,self.increment,out=state)
+        if self.model.profiler is not None: self.model.profiler.lap('update')
+        self.model.update_ghost_cells()
+
+    def step(self):
+        self.initial[...] = self.model.state
+        self.euler()
+        self.euler()
+        self.combine(3/4)
+        self.euler()
+        self.combine(1/3)
+
+    def get_stable_time_step(self):
+        return min(numpy.min(math.sqrt(3)/get_max_frequency(self.model)),2.5/get_max_rate(self.model))
+
+# SemiImplicit
+#
+# Rotation, drag, and wind are treated explicitly, but the gravity wave terms
+# are implicit, which makes the gravity waves stable for any time step:
+#     U* = U + dT*(rotU - dragConst*U + windU), likewise V*
+#     H' = H + dT*dHdT(U' ,V'), where U' = U* - dT*flowConst*dHdX(H'), likewise V'
+# Substituting for U' and V' gives an elliptic equation for H',
+#     (1 - c*L)H' = H + dT*dHdT(U*,V*), where c = dT*dT*flowConst*HBackground/dX
+# in which L is the Laplacian, formed from the same differences as dHdX, dHdY,
+# dUdX, and dVdY. This is solved using a sparse LU decomposition from scipy,
+# which is calculated once for each value of dT.
+
+class SemiImplicit(Integrator):
+    name = 'semi_implicit'
+
+    def __init__(self,model):
+        super().__init__(model)
+        self.dT      = None
+        self.solvers = []
+
+    # get_laplacian
+    #
+    # Matrix representing the Laplacian for H, flattened by rows. Gradients are
+    # not applied to U at column 0, which is either a wall or (as in
+    # momentum_tendencies) has a zero gradient because of the ghost column, nor
+    # at the wall V[nrow]. As in height_tendency, the divergence of V is not
+    # calculated for row 0.
+
+    def get_laplacian(self):
+        from scipy import sparse
+        model     = self.model
+        nrow,ncol = model.nrow,model.ncol
+        Dx        = sparse.diags([numpy.ones(ncol-1),-2*numpy.ones(ncol),numpy.ones(ncol-1)],[-1,0,1],format='lil')
+        Dx[0,0]   = -1
+        Dx[-1,-1] = -1
+        Dy        = sparse.lil_matrix((nrow,nrow))
+        for i in range(1,nrow):
+            Dy[i,i-1] += 1
+            Dy[i,i]   -= 1
+            if i+1 < nrow:
+                Dy[i,i]   -= 1
+                Dy[i,i+1] += 1
+        return (sparse.kron(sparse.identity(nrow),Dx)/model.dX**2 + sparse.kron(Dy,sparse.identity(ncol))/model.dY**2)
+
+    # Factorize (1 - c*L) for each member
+
+    def factorize(self):
+        from scipy import sparse
+        from scipy.sparse.linalg import splu
+        model        = self.model
+        laplacian    = self.get_laplacian()
+        identity     = sparse.identity(model.nrow*model.ncol)
+        c            = model.dT*model.dT*numpy.asarray(model.flowConst,dtype=float)*model.HBackground/model.dX
+        self.solvers = [splu(sparse.csc_matrix(identity - cc*laplacian)) for cc in numpy.ravel(c)]
+        self.dT      = model.dT
+
+    def step(self):
+        model,ncol,nrow,work = self.model,self.model.ncol,self.model.nrow,self.model.work
+        U,V,H,dT             = model.U,model.V,model.H,model.dT
+        if self.dT != dT:
+            self.factorize()
+            if model.profiler is not None: model.profiler.lap('update')
+
+        # Explicit terms
+        model.calculate_rotation()
+        if model.profiler is not None: model.profiler.lap('rotation')
+        numpy.multiply(model.dragConst,U[...,0:ncol],out=work)
+        numpy.subtract(model.rotU,work,out=work)
+        numpy.add(work,model.windColumn,out=work)
+        numpy.multiply(work,dT,out=work)
+        numpy.add(U[...,0:ncol],work,out=U[...,0:ncol])
+        numpy.multiply(model.dragConst,V[...,0:nrow,:],out=work)
+        numpy.subtract(model.rotV,work,out=work)
+        numpy.multiply(work,dT,out=work)
+        numpy.add(V[...,0:nrow,:],work,out=V[...,0:nrow,:])
+        if model.profiler is not None: model.profiler.lap('update')
+        model.update_ghost_cells()
+
+        # Solve for H
+        model.height_tendency()
+        numpy.multiply(model.dHdT,dT,out=work)
+        numpy.add(H[...,0:ncol],work,out=work)
+        rhs = work.reshape(-1,nrow*ncol)
+        for i,solver in enumerate(self.solvers):
+            rhs[i] = solver.solve(rhs[i])
+        H[...,0:ncol] = work
+        if model.profiler is not None: model.profiler.lap('update')
+        model.update_ghost_cells()
+
+        # Update U and V using gradient of new H
+        model.momentum_gradients()
+        numpy.multiply(model.dHdX[...,0:ncol],dT*model.flowConst,out=work)
+        numpy.subtract(U[...,0:ncol],work,out=U[...,0:ncol])
+        numpy.multiply(model.dHdY,dT*model.flowConst,out=work)
+        numpy.subtract(V[...,0:nrow,:],work,out=V[...,0:nrow,:])
+        if model.profiler is not None: model.profiler.lap('update')
+        model.update_ghost_cells()
+
+    def get_stable_time_step(self):
+        return 2/get_max_rate(self.model)
+
+INTEGRATORS = {integrator.name : integrator for integrator in [ForwardEuler,ForwardBackward,Leapfrog,RungeKutta3,SemiImplicit]}
+
+# TimeStepController
+#
+# Choose the time step for each slice: the largest step that is stable, reduced by
+# a safety factor, and never more than dTmax. The step is chosen so that a whole
+# number of steps spans the slice exactly. The limit is calculated for the first
+# slice, or for every slice if reevaluate is True, e.g. if the parameters of the
+# model are changed during the run. history records the steps that were used,
+# as (itGlobal, dT, number of steps).
+
+class TimeStepController:
+    def __init__(self,safety=0.9,reevaluate=False,dTmax=None):
+        self.safety     = safety
+        self.reevaluate = reevaluate
+        self.dTmax      = dTmax
+        self.limit      = None
+        self.history    = []
+
+    # advance
+    #
+    # Step the model forward by duration seconds
+
+    def advance(self,model,duration):
+        if self.limit is None or self.reevaluate:
+            self.limit = self.safety * get_stable_time_step(model)
+            if self.dTmax is not None:
+                self.limit = min(self.limit,self.dTmax)
+        n        = max(1,math.ceil(duration/self.limit))
+        model.dT = duration/n
+        self.history.append((model.itGlobal,model.dT,n))
+        return model.step(n)
+
+    def report(self):
+        for itGlobal,dT,n in self.history:
+            if itGlobal==self.history[0][0] or dT != previous:
+                print ('Step {0}: dT={1:.6g} seconds, {2} steps per slice'.format(itGlobal,dT,n))
+            previous = dT
+
+# write_checkpoint
+#
+# Save the state of a model, with the number of steps taken, and the parameters
+# needed to recreate it, in numpy's npz format. The file is written to a
+# temporary file in the same folder, then renamed, so an existing checkpoint is
+# only replaced once the new one is complete: if the job is killed part way
+# through a write, the previous checkpoint survives. Integrators that need more
+# than the current state, e.g. leapfrog, save it as integrator.
+
+def write_checkpoint(path,class_name,parameters,itGlobal,time,state,integrator=None):
+    folder = os.path.dirname(os.path.abspath(path))
+    extras = {} if integrator is None else {'integrator':integrator}
+    with tempfile.NamedTemporaryFile(dir=folder,suffix='.tmp',delete=False) as temporary:
+        numpy.savez(temporary,
+                    class_name = numpy.array(class_name),
+                    parameters = numpy.array(json.dumps(parameters)),
+                    itGlobal   = numpy.array(itGlobal),
+                    time       = numpy.array(time),
+                    state      = state,
+                    **extras)
+        temporary.flush()
+        os.fsync(temporary.fileno())
+    os.replace(temporary.name,path)
+
+# load
+#
+# Restart a model, or ensemble, from a checkpoint. Because the scratch arrays are
+# recalculated at every step, the state and the step count are enough for the
+# model to continue exactly as it would have done if it hadn't been interrupted.
+
+def load(path):
+    with numpy.load(path) as checkpoint:
+        model = globals()[str(checkpoint['class_name'])](**json.loads(str(checkpoint['parameters'])))
+        model.state[...] = checkpoint['state']
+        model.itGlobal   = int(checkpoint['itGlobal'])
+        model.time       = float(checkpoint['time'])
+        if 'integrator' in checkpoint:
+            model.integrator.set_state(checkpoint['integrator'])
+    return model
+
+# Checkpointer
+#
+# Write checkpoints periodically, from a background thread: write() is called
+# after each slice, and saves one slice in every interval. The time loop only
+# waits while the state is copied, or, if the previous checkpoint hasn't been
+# written yet, until it has.
+
+class Checkpointer:
+    def __init__(self,path,interval=10):
+        self.path     = path
+        self.interval = interval
+        self.count    = 0
+        self.error    = None
+        self.queue    = queue.Queue(maxsize=1)
+        self.thread   = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def write(self,model):
+        self.count += 1
+        if self.count % self.interval == 0:
+            if self.error is not None: raise self.error
+            integrator = model.integrator.get_state()
+            self.queue.put((type(model).__name__,model.get_parameters(),model.itGlobal,model.time,model.state.copy(),
+                            None if integrator is None else integrator.copy()))
+
+    def run(self):
+        while True:
+            checkpoint = self.queue.get()
+            if checkpoint is None: break
+            try:
+                write_checkpoint(self.path,*checkpoint)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None: raise self.error
+
+# Trajectories
+#
+# A trajectory file stores snapshots of the model in a form that can be memory
+# mapped, so a long run can be analyzed without reading it all into memory.
+# The file starts with a header:
+#     magic number (8 bytes)
+#     number of snapshots written (int64)
+#     length of the description (int64)
+#     JSON description: dtype, shapes of fields, dT, stride, and the model parameters
+# padded to a whole number of pages, since the description of an ensemble grows
+# with the number of members. This is followed by one fixed size record for each
+# snapshot, containing itGlobal, the time in seconds, and the selected fields.
+
+TRAJECTORY_MAGIC = b'SWTRAJ02'
+PAGE_SIZE        = 4096
+
+def get_record_dtype(fields,shapes,dtype):
+    return numpy.dtype([('itGlobal','<i8'),('time','<f8')] + [(name,dtype,tuple(shape)) for name,shape in zip(fields,shapes)])
+
+def get_header_size(length):
+    return PAGE_SIZE * -(-(len(TRAJECTORY_MAGIC) + 16 + length) // PAGE_SIZE)
+
+# read_trajectory_header
+#
+# Returns (number of snapshots,description,header size)
+
+def read_trajectory_header(path):
+    with open(path,'rb') as file:
+        if file.read(len(TRAJECTORY_MAGIC)) != TRAJECTORY_MAGIC:
+            raise ValueError('{0} is not a trajectory file'.format(path))
+        count,length = numpy.frombuffer(file.read(16),dtype='<i8').tolist()
+        description  = json.loads(file.read(length).decode())
+    return (count,description,get_header_size(length))
+
+# TrajectoryWriter
+#
+# Append snapshots of H, U, V, and optionally the tendencies, to a trajectory
+# file. Space is preallocated for capacity snapshots; if this is exhausted, the
+# file is extended. write() is called after each slice, and one slice in every
+# stride is saved; first is the number of the slice that the model has reached.
+#
+# When a run is restarted from a checkpoint, append should be True: an existing
+# trajectory written by the same run is kept, up to the snapshot where the
+# model was checkpointed, and the new snapshots are written after it. Only dT
+# may differ, since it may have been changed by a TimeStepController.
+
+class TrajectoryWriter:
+    def __init__(self,path,model,capacity=100,stride=1,tendencies=False,first=0,append=False):
+        self.path     = path
+        self.stride   = stride
+        self.calls    = first
+        self.count    = 0
+        self.fields   = ['H','U','V'] + (['dHdT','dUdT','dVdT'] if tendencies else [])
+        shapes        = [getattr(model,name).shape for name in self.fields]
+        self.dtype    = get_record_dtype(self.fields,shapes,model.state.dtype.str)
+        description   = json.dumps({'dtype'      : model.state.dtype.str,
+                                    'fields'     : self.fields,
+                                    'shapes'     : shapes,
+                                    'dT'         : model.dT,
+                                    'stride'     : stride,
+                                    'class_name' : type(model).__name__,
+                                    'parameters' : model.get_parameters()}).encode()
+        if append and os.path.exists(path):
+            count,stored,self.header_size = read_trajectory_header(path)
+            if not same_run(stored,json.loads(description.decode())):
+                raise ValueError('{0} was not written by the run that is being restarted'.format(path))
+            records    = numpy.memmap(path,dtype=self.dtype,mode='r',offset=self.header_size,shape=(count,))
+            self.count = int(numpy.searchsorted(records['itGlobal'],model.itGlobal))
+            del records
         else:
-            windU.append( 0 )
-    return windU
+            self.header_size = get_header_size(len(description))
+            with open(path,'wb') as file:
+                file.write(TRAJECTORY_MAGIC)
+                file.write(numpy.array([0,len(description)],dtype='<i8').tobytes())
+                file.write(description.ljust(self.header_size - len(TRAJECTORY_MAGIC) - 16))
+        self.map(max(capacity,self.count+1))
+        self.header[0] = self.count
 
-def firstFrame():
-    global fig, ax, hPlot
-    fig, ax = plt.subplots()
-    ax.set_title("H")   
-    hh = H[:,0:ncol]
+    # Map the header, and space for capacity records, extending file as needed
+
+    def map(self,capacity):
+        self.capacity = capacity
+        self.header   = numpy.memmap(self.path,dtype='<i8',mode='r+',offset=len(TRAJECTORY_MAGIC),shape=(1,))
+        self.records  = numpy.memmap(self.path,dtype=self.dtype,mode='r+',offset=self.header_size,shape=(capacity,))
+
+    def write(self,model):
+        if self.calls % self.stride == 0:
+            if self.count == self.capacity:
+                self.records.flush()
+                del self.records
+                self.map(2*self.capacity)
+            record             = self.records[self.count]
+            record['itGlobal'] = model.itGlobal
+            record['time']     = model.time
+            for name in self.fields:
+                record[name]   = getattr(model,name)
+            self.count        += 1
+            self.header[0]     = self.count
+        self.calls += 1
+
+    def close(self):
+        self.records.flush()
+        self.header.flush()
+        del self.records
+        del self.header
+        with open(self.path,'r+b') as file:   # discard any unused preallocated space
+            file.truncate(self.header_size + self.count*self.dtype.itemsize)
+
+# same_run
+#
+# Used to verify that two trajectory descriptions are from the same run: they
+# must agree in everything but dT.
+
+def same_run(description1,description2):
+    def strip(description):
+        return dict(description,dT=None,parameters=dict(description['parameters'],dT=None))
+    return strip(description1) == strip(description2)
+
+# Trajectory
+#
+# Read a trajectory file. The snapshots are memory mapped, so nothing is read
+# until it is used, and get() returns views into the file rather than copies, e.g.
+#    trajectory = Trajectory('run.traj')
+#    H = trajectory.get('H',100,200)   # snapshots 100 to 199
+#    days = trajectory.get_days()
+
+class Trajectory:
+    def __init__(self,path):
+        count,description,header_size = read_trajectory_header(path)
+        self.fields     = description['fields']
+        self.shapes     = description['shapes']
+        self.dT         = description['dT']
+        self.stride     = description['stride']
+        self.class_name = description['class_name']
+        self.parameters = description['parameters']
+        self.records    = numpy.memmap(path,dtype=get_record_dtype(self.fields,self.shapes,description['dtype']),
+                                       mode='r',offset=header_size,shape=(count,))
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self,name,start=None,stop=None,step=None):
+        return self.records[name][start:stop:step]
+
+    def get_days(self,start=None,stop=None,step=None):
+        return self.get('time',start,stop,step) / 86400.
+
+# get_arrows
+#
+# Calculate the positions and lengths of the arrows that show the flow. U is
+# drawn on the western edge of each cell, and V on the northern edge.
+# Returns (x,y,u,v) for the U arrows, followed by (x,y,u,v) for the V arrows.
+
+def get_arrows(U,V,arrowScale):
+    nrow,ncol = U.shape[0],V.shape[1]
+    yy,xx     = numpy.mgrid[0:nrow,0:ncol]
+    zeros     = numpy.zeros((nrow,ncol))
+    return ((xx - 0.5, yy, U[:,0:ncol] * arrowScale, zeros),
+            (xx, yy - 0.5, zeros, -V[0:nrow,:] * arrowScale))
+
+# draw_frame
+#
+# Create the image of H, and the arrows, on a set of axes.
+# Returns the image and the two quivers, so they can be updated for later frames.
+
+def draw_frame(ax,H,U,V,arrowScale):
+    import matplotlib.ticker as tkr
+    ax.set_title("H")
     loc = tkr.IndexLocator(base=1, offset=1)
     ax.xaxis.set_major_locator(loc)
     ax.yaxis.set_major_locator(loc)
-    grid = ax.grid(which='major', axis='both', linestyle='-')
-    hPlot = ax.imshow(hh, interpolation='nearest', clim=(-0.5,0.5))   
-    plotArrows()
-    plt.show(block=False) 
-
-def plotArrows():
-    global quiv, quiv2
-    xx = []
-    yy = []
-    uu = []
-    vv = []
-    for irow in range( 0, nrow ):
-        for icol in range( 0, ncol ):
-            xx.append(icol - 0.5)
-            yy.append(irow )
-            uu.append( U[irow,icol] * arrowScale )
-            vv.append( 0 )
-    quiv = ax.quiver( xx, yy, uu, vv, color='red', scale=1)
-    for irow in range( 0, nrow ):
-        for icol in range( 0, ncol ):
-            xx.append(icol)
-            yy.append(irow - 0.5)
-            uu.append( 0 )
-            vv.append( -V[irow,icol] * arrowScale )
-    quiv2 = ax.quiver( xx, yy, uu, vv, color='red', scale=1)
-
-def updateFrame():
+    ax.grid(which='major', axis='both', linestyle='-')
+    hPlot       = ax.imshow(H, interpolation='nearest', clim=(-0.5,0.5))
+    arrowsU,arrowsV = get_arrows(U,V,arrowScale)
+    quiv        = ax.quiver(*arrowsU, color='red', scale=1)
+    quiv2       = ax.quiver(*arrowsV, color='red', scale=1)
+    return (hPlot,quiv,quiv2)
+
+# update_frame_data
+#
+# Replace the data in an image and its arrows, without recreating them
+
+def update_frame_data(hPlot,quiv,quiv2,H,U,V,arrowScale):
+    hPlot.set_array(H)
+    arrowsU,arrowsV = get_arrows(U,V,arrowScale)
+    quiv.set_UVC(arrowsU[2],arrowsU[3])
+    quiv2.set_UVC(arrowsV[2],arrowsV[3])
+
+def firstFrame(model,arrowScale):
     global fig, ax, hPlot, quiv, quiv2
-    hh = H[:,0:ncol]
-    hPlot.set_array(hh)
-    quiv.remove()    
-    quiv2.remove()
-    plotArrows()
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    hPlot,quiv,quiv2 = draw_frame(ax,model.H[:,0:model.ncol],model.U,model.V,arrowScale)
+    plt.show(block=False)
+
+def updateFrame(model,arrowScale):
+    import matplotlib.pyplot as plt
+    update_frame_data(hPlot,quiv,quiv2,model.H[:,0:model.ncol],model.U,model.V,arrowScale)
     plt.show( block=False )
-    plt.pause(0.001)    
+    plt.pause(0.001)
     fig.canvas.draw()
-    print("Time: ", math.floor( itGlobal * dT / 86400.*10)/10, "days")
-    
-def textDump():
-    print("time step ", itGlobal)    
-    print("H", H)
+    print("Time: ", math.floor( model.get_days()*10)/10, "days")
+
+# FrameWriter
+#
+# Write frames without a display, e.g. on a compute node. Frames are either
+# rendered as a sequence of images, frame-00000.png, frame-00001.png,... using
+# matplotlib's non-interactive Agg canvas, or collected as arrays and saved
+# to a single file, frames.npz, when the writer is closed.
+#
+# write() is called after each slice, but only one slice in every stride is
+# kept. If background is True, frames are passed through a queue to a thread
+# that renders them, so the model doesn't wait for rendering.
+#
+#    writer = FrameWriter('frames',stride=10,background=True)
+#    writer.write(model)
+#    for i in range(nSlices):
+#        writer.write(model.step(ntAnim))
+#    writer.close()
+
+class FrameWriter:
+    def __init__(self,path,format='png',stride=1,arrowScale=30,background=False,queue_size=16):
+        if format not in ['png','npz']:
+            raise ValueError('Unknown format for frames: {0}'.format(format))
+        self.path       = path
+        self.format     = format
+        self.stride     = stride
+        self.arrowScale = arrowScale
+        self.count      = 0
+        self.written    = 0
+        self.figure     = None
+        self.frames     = {'itGlobal':[],'days':[],'H':[],'U':[],'V':[]}
+        self.error      = None
+        self.thread     = None
+        os.makedirs(path,exist_ok=True)
+        if background:
+            self.queue  = queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(target=self.run,daemon=True)
+            self.thread.start()
+
+    def write(self,model):
+        if self.count % self.stride == 0:
+            frame = (model.itGlobal,model.get_days(),model.H[:,0:model.ncol].copy(),model.U.copy(),model.V.copy())
+            if self.thread is None:
+                self.save(*frame)
+            else:
+                if self.error is not None: raise self.error
+                self.queue.put(frame)
+        self.count += 1
+
+    # Save one frame, either as an image or in memory
+
+    def save(self,itGlobal,days,H,U,V):
+        if self.format == 'npz':
+            for name,value in zip(['itGlobal','days','H','U','V'],[itGlobal,days,H,U,V]):
+                self.frames[name].append(value)
+        else:
+            if self.figure is None:
+                from matplotlib.figure import Figure
+                from matplotlib.backends.backend_agg import FigureCanvasAgg
+                self.figure = Figure()
+                FigureCanvasAgg(self.figure)
+                self.ax     = self.figure.add_subplot(1,1,1)
+                self.hPlot,self.quiv,self.quiv2 = draw_frame(self.ax,H,U,V,self.arrowScale)
+            else:
+                update_frame_data(self.hPlot,self.quiv,self.quiv2,H,U,V,self.arrowScale)
+            self.ax.set_title('H: {0:.1f} days'.format(math.floor(days*10)/10))
+            self.figure.savefig(os.path.join(self.path,'frame-{0:05d}.png'.format(self.written)))
+        self.written += 1
+
+    # Body of background thread: save frames until we receive None
+
+    def run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None: break
+            try:
+                if self.error is None:
+                    self.save(*frame)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            if self.error is not None: raise self.error
+        if self.format == 'npz':
+            numpy.savez(os.path.join(self.path,'frames.npz'),
+                        **{name:numpy.array(values) for name,values in self.frames.items()})
+
+def textDump(model):
+    print("time step ", model.itGlobal)
+    print("H", model.H)
     print("dHdX" )
-    print( dHdX)
+    print( model.dHdX)
     print("dHdY" )
-    print( dHdY)
+    print( model.dHdY)
     print("U" )
-    print( U)
+    print( model.U)
     print("dUdX" )
-    print( dUdX)
+    print( model.dUdX)
     print("rotV" )
-    print( rotV)
+    print( model.rotV)
     print("V" )
-    print( V)
+    print( model.V)
     print("dVdY" )
-    print( dVdY)
+    print( model.dVdY)
     print("rotU" )
-    print( rotU)
+    print( model.rotU)
     print("dHdT" )
-    print( dHdT)
+    print( model.dHdT)
     print("dUdT" )
-    print( dUdT)
+    print( model.dUdT)
     print("dVdT" )
-    print( dVdT)
+    print( model.dVdT)
 
 # Provide command level help
 
 def help():
-  print ('Iterative Relaxation to Consistent T and Albedo Given L ')
+  print ('Pressure, Rotation, and Fluid Flow')
   print ('Global Warming II: Create Your Own Models in Python')
   print ('Usage:')
   print ('   a. To pass grader:')
-  print ('      python relaxation.py')
+  print ('      python shallow.py')
   print ('   b. For code review:')
-  print ('      python relaxation.py -p')
+  print ('      python shallow.py -p')
   print ('   c. Additional arguments')
-  print ('      -h --help      To get usage instructions')
-  print ('      -v --version   To find version of model')
-  print ('      -p --plot      Species that output is to be plotted')
+  print ('      -h --help          To get usage instructions')
+  print ('      -v --version       To find version of model')
+  print ('      -p --plot          Specifies that output is to be plotted')
+  print ('      -t --text          Specifies that arrays are to be printed')
+  print ('      -c --ncol          Grid size (number of cells)')
+  print ('      -n --slices        Number of frames')
+  print ('      -a --anim          Number of time steps for each frame')
+  print ('      -H --wrap          Flow wraps around from right to left')
+  print ('      -i --interpolate   Use interpolated (full) rotation')
+  print ('      -g --algorithm     Rotation algorithm: trivial, easy, or full')
+  print ('      -r --rotation      Rotation scheme: WithLatitude, PlusMinus, or Uniform')
+  print ('      -s --wind          Wind scheme: Curled or Uniform')
+  print ('      -u --perturbation  Initial perturbation: Tower, NSGradient, or EWGradient')
+  print ('      -w --arrows        Scale for arrows')
+  print ('      -l --loops         Use loops instead of vectorized time step (reference)')
+  print ('      -o --output        Write frames to this folder, without a display')
+  print ('      -f --format        Format for frames: png (default) or npz')
+  print ('      -k --stride        Write one frame for every stride slices')
+  print ('      -b --background    Write frames from a background thread')
+  print ('      -C --checkpoint    Write checkpoints to this file')
+  print ('      -e --every         Number of slices between checkpoints')
+  print ('      -R --restart       Restart from this checkpoint')
+  print ('      -T --trajectory    Save snapshots to this trajectory file, one for every stride slices')
+  print ('                         (with -R, snapshots after the checkpoint are added to the file)')
+  print ('      -D --tendencies    Include tendencies in trajectory')
+  print ('      -G --gravity       Acceleration due to gravity, m/s2')
+  print ('      -x --dx            Size of grid cells, meters')
+  print ('      -A --adaptive      Use largest stable time step, reduced by this safety factor')
+  print ('      -S --reevaluate    Recalculate adaptive time step for each slice')
+  print ('      -I --integrator    Integrator: euler, forward_backward, leapfrog, rk3, or semi_implicit')
+  print ('      -P --processes     Divide grid into bands of rows, stepped by this number of processes')
+  print ('         --scaling       Time anim steps for up to --processes processes (strong scaling), then exit')
+  print ('         --profile       Print time spent in each phase of the time step')
+  print ('         --profile-dump  Save time spent in each phase to this file (JSON)')
+  print ('         --diagnostics   Check mass, energy, and Courant number every this number of steps')
+  print ('         --diagnostics-log  Write diagnostics to this file, instead of the console')
+  print ('         --energy-growth Stop if energy grows by more than this factor between checks')
+  print ('         --energy-limit  Stop if energy exceeds this value')
+
 
-  
 # Determine revision number from subversion
 
 def version(tag='$LastChangedRevision: 1066 $'):
@@ -352,9 +1934,10 @@ def version(tag='$LastChangedRevision: 1066 $'):
 
 # Shallow.py is ineteded to be executed from the command line. Paramters can be specified
 # to control execution. If the program is executed with no paramters at all, it will execute
-# with default values that correspond to 
+# with default values that correspond to
 # https://www.coursera.org/learn/global-warming-model/programming/023Rg/code-check
-# i.e. for the grader: python shallow.py 
+# i.e. for the grader: python shallow.py
+# The grader supplies the row and column whose values are to be printed.
 #
 # To run the 1st code trick, use these values
 #
@@ -368,83 +1951,238 @@ def version(tag='$LastChangedRevision: 1066 $'):
 if __name__=='__main__':
   # Set up defasult values for grader
   ncol = 5           # grid size (number of cells)
-  nrow = ncol
   nSlices = 400         # maximum number of frames to show in the plot
   ntAnim = 1000  # number of time steps for each frame
-  
+
   horizontalWrap = False # determines whether the flow wraps around, connecting
-                         # the left and right-hand sides of the grid, 
-                         # or whether there's a wall there. 
-  interpolateRotation = True
+                         # the left and right-hand sides of the grid,
+                         # or whether there's a wall there.
+  rotationAlgorithm = 'trivial_rotation'
   rotationScheme = "PlusMinus"   # "WithLatitude", "PlusMinus", "Uniform"
-  
+
   # Note: the rotation rate gradient is more intense than the real world, so that
   # the model can equilibrate quickly.
-  
+
   windScheme = 'Curled' #"Uniform"  # "Curled", "Uniform"
   initialPerturbation = ""    # "Tower", "NSGradient", "EWGradient"
 
   arrowScale = 30
 
   textOutput = False
-  plotOutput = True  
-  dT = 600 # seconds
-  G = 9.8e-4 # m/s2, hacked (low-G) to make it run faster
-  HBackground = 4000 # meters
-  
-  dX = 10.0E3 # meters, small enough to respond quickly.  This is a very small ocean
-              # on a very small, low-G planet.  
-  dY = dX        #FIXME
-  
-  dxDegrees = dX / 110.e3
-  dyDegrees = dY / 110.e3
-  flowConst = G  # 1/s2
-  dragConst = 1.E-6  # about 10 days decay time
-  meanLatitude = 30 # degrees
-  rotationAlgorithm = full_rotation
- 
-  latitude,rotConst=createRotation(nrow,rotationScheme)
-  windU = createWind(nrow,windScheme)
-
-  itGlobal = 0
-
-  U = numpy.zeros((nrow, ncol+1))
-  V = numpy.zeros((nrow+1, ncol))
-  H = numpy.zeros((nrow, ncol+1))
-  dUdT = numpy.zeros((nrow, ncol))
-  dVdT = numpy.zeros((nrow, ncol))
-  dHdT = numpy.zeros((nrow, ncol))
-  dHdX = numpy.zeros((nrow, ncol+1))
-  dHdY = numpy.zeros((nrow, ncol))
-  dUdX = numpy.zeros((nrow, ncol))
-  dVdY = numpy.zeros((nrow, ncol))
-  rotV = numpy.zeros((nrow,ncol)) # interpolated to u locations
-  rotU = numpy.zeros((nrow,ncol)) #              to v
-      
-  midCell = int(ncol/2)
-  if initialPerturbation == "Tower":
-      H[midCell,midCell] = 1
-  elif initialPerturbation == "NSGradient":
-      H[0:midCell,:] = 0.1
-  elif initialPerturbation == "EWGradient":
-      H[:,0:midCell] = 0.1    
-  
+  plotOutput = False  # Grader doesn't like plotting!
+  reference  = False
+  output     = None   # Folder for headless frames
+  format     = 'png'
+  stride     = 1
+  background = False
+  checkpoint = None   # File for checkpoints
+  every      = 10     # Slices between checkpoints
+  restart    = None   # Checkpoint from which to restart
+  trajectory = None   # File for snapshots
+  tendencies = False  # Include tendencies in snapshots
+  dT         = 600    # seconds
+  G          = 9.8e-4 # m/s2, hacked (low-G) to make it run faster
+  dX         = 10.0E3 # meters, small enough to respond quickly.  This is a very small ocean
+                      # on a very small, low-G planet.
+  safety     = None   # Safety factor for adaptive time step
+  reevaluate = False
+  integrator = 'euler'
+  processes  = None   # Number of processes for domain decomposition
+  scaling    = False
+  profile    = False  # Time each phase of the time step
+  profile_dump = None
+  diagnostics  = None # Steps between checks
+  diagnostics_log = None
+  energy_growth   = None
+  energy_limit    = None
+
+  try:
+    opts, args = getopt.getopt( \
+          sys.argv[1:],\
+          'hvptc:n:a:Hig:r:s:u:w:lo:f:k:bC:e:R:T:DG:x:A:SI:P:',\
+          ['help','version','plot','text','ncol=','slices=','anim=','wrap','interpolate',
+           'algorithm=','rotation=','wind=','perturbation=','arrows=','loops',
+           'output=','format=','stride=','background','checkpoint=','every=','restart=',
+           'trajectory=','tendencies','gravity=','dx=','adaptive=','reevaluate','integrator=',
+           'processes=','scaling','profile','profile-dump=',
+           'diagnostics=','diagnostics-log=','energy-growth=','energy-limit='])
+  except getopt.GetoptError as e:
+    print (e)
+    help()
+    sys.exit(2)
+
+  for opt, arg in opts:
+    if opt in ['-h','--help']:
+      help()
+      sys.exit()
+    elif opt in ['-v','--version']:
+      print ('{0} revision {1}'.format(os.path.basename(sys.argv[0]), version()))
+      sys.exit()
+    elif opt in ['-p','--plot']:
+      plotOutput = True
+    elif opt in ['-t','--text']:
+      textOutput = True
+    elif opt in ['-c','--ncol']:
+      ncol = int(arg)
+    elif opt in ['-n','--slices']:
+      nSlices = int(arg)
+    elif opt in ['-a','--anim']:
+      ntAnim = int(arg)
+    elif opt in ['-H','--wrap']:
+      horizontalWrap = True
+    elif opt in ['-i','--interpolate']:
+      rotationAlgorithm = 'full_rotation'
+    elif opt in ['-g','--algorithm']:
+      rotationAlgorithm = arg if arg.endswith('_rotation') else arg + '_rotation'
+    elif opt in ['-r','--rotation']:
+      rotationScheme = arg
+    elif opt in ['-s','--wind']:
+      windScheme = arg
+    elif opt in ['-u','--perturbation']:
+      initialPerturbation = arg
+    elif opt in ['-w','--arrows']:
+      arrowScale = float(arg)
+    elif opt in ['-l','--loops']:
+      reference = True
+    elif opt in ['-o','--output']:
+      output = arg
+    elif opt in ['-f','--format']:
+      format = arg
+    elif opt in ['-k','--stride']:
+      stride = int(arg)
+    elif opt in ['-b','--background']:
+      background = True
+    elif opt in ['-C','--checkpoint']:
+      checkpoint = arg
+    elif opt in ['-e','--every']:
+      every = int(arg)
+    elif opt in ['-R','--restart']:
+      restart = arg
+    elif opt in ['-T','--trajectory']:
+      trajectory = arg
+    elif opt in ['-D','--tendencies']:
+      tendencies = True
+    elif opt in ['-G','--gravity']:
+      G = float(arg)
+    elif opt in ['-x','--dx']:
+      dX = float(arg)
+    elif opt in ['-A','--adaptive']:
+      safety = float(arg)
+    elif opt in ['-S','--reevaluate']:
+      reevaluate = True
+    elif opt in ['-I','--integrator']:
+      integrator = arg
+    elif opt in ['-P','--processes']:
+      processes = int(arg)
+    elif opt in ['--scaling']:
+      scaling = True
+    elif opt in ['--profile']:
+      profile = True
+    elif opt in ['--profile-dump']:
+      profile_dump = arg
+    elif opt in ['--diagnostics']:
+      diagnostics = int(arg)
+    elif opt in ['--diagnostics-log']:
+      diagnostics_log = arg
+    elif opt in ['--energy-growth']:
+      energy_growth = float(arg)
+    elif opt in ['--energy-limit']:
+      energy_limit = float(arg)
+
+  if scaling:
+    scaling_benchmark(ncol,ntAnim,[2**i for i in range(int(math.log2(processes or os.cpu_count()))+1)],
+                      horizontalWrap,rotationAlgorithm)
+    sys.exit()
+
+  if len(opts)==0:
+    iRowOut, iColOut = [int(x) for x in input("").split()]
+
+  if restart is None:
+    Model = ShallowWaterModel if processes is None else functools.partial(DecomposedShallowWaterModel,processes)
+    model = Model(            ncol                = ncol,
+                              horizontalWrap      = horizontalWrap,
+                              rotationScheme      = rotationScheme,
+                              windScheme          = windScheme,
+                              initialPerturbation = initialPerturbation,
+                              rotationAlgorithm   = rotationAlgorithm,
+                              reference           = reference,
+                              integrator          = integrator,
+                              dT                  = dT,
+                              G                   = G,
+                              dX                  = dX)
+  else:  # parameters are taken from the checkpoint, and we continue with the next slice
+    model = load(restart)
+
+  writer       = None if output is None else FrameWriter(output,format,stride,arrowScale,background)
+  checkpointer = None if checkpoint is None else Checkpointer(checkpoint,every)
+  controller   = None if safety is None else TimeStepController(safety,reevaluate)
+  sliceDuration = ntAnim * dT  # seconds; with an adaptive time step, the number of steps may vary
+  firstSlice    = int(round(model.time/sliceDuration))   # after a restart, the slice from the checkpoint
+  trajectory_writer = None if trajectory is None else TrajectoryWriter(trajectory,model,nSlices//stride+1,stride,
+                                                                        tendencies,firstSlice,restart is not None)
+
+  if profile or profile_dump is not None:
+      model.profile()
+  if diagnostics is not None:
+      model.diagnostics = Diagnostics(sys.stdout if diagnostics_log is None else diagnostics_log,
+                                      diagnostics,energy_growth,energy_limit)
+  unstable = None
   if textOutput is True:
-      textDump()
+      textDump(model)
   if plotOutput is True:
-      firstFrame()
-  for i_anim_step in range(0,nSlices):
-      animStep()
+      firstFrame(model,arrowScale)
+  if writer is not None:
+      writer.write(model)
+  if trajectory_writer is not None:
+      trajectory_writer.write(model)
+  for i_anim_step in range(firstSlice,nSlices):
+      try:
+          if controller is None:
+              model.step(ntAnim)
+          else:
+              controller.advance(model,sliceDuration)
+      except InstabilityError as e:
+          unstable = e
+          print (e)
+          break
       if textOutput:
-          textDump()
+          textDump(model)
       if plotOutput:
-          updateFrame()
+          updateFrame(model,arrowScale)
+      if writer is not None:
+          writer.write(model)
+      if checkpointer is not None:
+          checkpointer.write(model)
+      if trajectory_writer is not None:
+          trajectory_writer.write(model)
+
+  if writer is not None:
+      writer.close()
+  if checkpointer is not None:
+      checkpointer.close()
+  if trajectory_writer is not None:
+      trajectory_writer.close()
+  if controller is not None:
+      controller.report()
+  if len(opts)>0 and model.integrator.steps>0:
+      model.integrator.report()
+  if isinstance(model,DecomposedShallowWaterModel):
+      model.close()
+  if profile:
+      model.profiler.report()
+  if profile_dump is not None:
+      model.profiler.dump(profile_dump,model)
+  if model.diagnostics is not None:
+      model.diagnostics.close()
+  if unstable is not None:
+      sys.exit(1)
 
 # If we are doing a Code Check, need to make sure that we produce the required output
 
   if len(opts)==0:
-    print(H[iRowOut,iColOut],dHdT[iRowOut,iColOut],U[iRowOut,iColOut],\
-        V[iRowOut,iColOut],rotU[iRowOut,iColOut])
-  
+    print(model.H[iRowOut,iColOut],model.dHdT[iRowOut,iColOut],model.U[iRowOut,iColOut],\
+        model.V[iRowOut,iColOut],model.rotU[iRowOut,iColOut])
+
   if plotOutput:
+    import matplotlib.pyplot as plt
     plt.show()
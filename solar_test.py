@@ -21,7 +21,6 @@ Model for solar irradiation, based on Solar Radiation on Mars,
 import math as m, kepler.solar as s, kepler.kepler as k,matplotlib.pyplot as plt
 import kepler.solar as s, kepler.kepler as k, matplotlib.cm as cm
 import numpy as np,itertools
-from scipy.integrate import quad 
 
 class Earth:
     def __init__(self):
@@ -0,0 +1,133 @@
+# (C) 2019 Greenweaves Software Limited
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+# Startup benchmark for the model scripts
+#
+# The graders run each script once per case, so most of the time of a short
+# run is starting Python and importing modules. For each case, run the script
+# several times in a fresh interpreter, and record the fastest wall time,
+# and which heavy modules (e.g. scipy, matplotlib) were imported.
+#
+# A case fails if it imports a heavy module, or is slower than the target.
+# Scripts that need numpy can't start before numpy is imported, so their
+# target is the time to start Python and import numpy, plus the target.
+#
+# The results are written as JSON, and the exit status is 1 if any case fails.
+
+import sys,getopt,os,json,time,subprocess,platform
+
+HEAVY   = ['scipy','matplotlib','pandas']
+TARGET  = 0.1      # seconds
+REPEATS = 10
+
+# Cases: script, arguments, standard input, and whether script needs numpy
+
+CASES = [('relaxation.py',  [],    '1200 0.3 5\n', False),
+         ('naked.py',       [],    '10\n',         False),
+         ('ice-sheet.py',   [],    '100\n',        False),
+         ('shallow.py',     ['-h'], '',            True),
+         ('near-future.py', ['-h'], '',            True)]
+
+# time_command
+#
+# Fastest of several runs of a command, in seconds
+
+def time_command(command,stdin='',repeats=REPEATS,cwd=None):
+    best = float('inf')
+    for i in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command,input=stdin,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL,
+                       universal_newlines=True,cwd=cwd,check=True)
+        best = min(best,time.perf_counter()-start)
+    return best
+
+# get_imports
+#
+# Top level packages imported by a command, using python -X importtime
+
+def get_imports(command,stdin='',cwd=None):
+    result = subprocess.run(command[:1]+['-X','importtime']+command[1:],input=stdin,stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,universal_newlines=True,cwd=cwd,check=True)
+    imports = set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            name = line.split('|')[-1].strip()
+            if not name.startswith('package'):
+                imports.add(name.split('.')[0])
+    return imports
+
+def benchmark(cases=CASES,target=TARGET,repeats=REPEATS):
+    directory = os.path.dirname(os.path.abspath(__file__))
+    baseline  = time_command([sys.executable,'-c','pass'],repeats=repeats)
+    numpy     = time_command([sys.executable,'-c','import numpy'],repeats=repeats)
+    print ('Python starts in {0:.3f} s, and imports numpy in {1:.3f} s'.format(baseline,numpy))
+    print ('{0:>15} {1:>5} {2:>9} {3:>9} {4}'.format('script','args','seconds','target','heavy imports'))
+    results = []
+    for script,arguments,stdin,needs_numpy in cases:
+        command = [sys.executable,script] + arguments
+        seconds = time_command(command,stdin,repeats,cwd=directory)
+        heavy   = sorted(get_imports(command,stdin,cwd=directory).intersection(HEAVY))
+        limit   = target + numpy if needs_numpy else target
+        results.append({'script'        : script,
+                        'arguments'     : arguments,
+                        'seconds'       : seconds,
+                        'target'        : limit,
+                        'heavy_imports' : heavy,
+                        'passed'        : seconds <= limit and len(heavy)==0})
+        print ('{script:>15} {0:>5} {seconds:>9.3f} {target:>9.3f} {1} {2}'.format(
+               ' '.join(arguments),','.join(heavy),'OK' if results[-1]['passed'] else 'FAILED',**results[-1]))
+    return {'python_seconds':baseline,'numpy_seconds':numpy,'cases':results}
+
+def help():
+    print ('Startup benchmark for the model scripts')
+    print ('Usage:')
+    print ('   python startup-benchmark.py [options]')
+    print ('      -h --help          To get usage instructions')
+    print ('      -t --target        Seconds allowed for each case, beyond importing numpy if needed, default {0}'.format(TARGET))
+    print ('      -r --repeats       Number of times to run each case, default {0}'.format(REPEATS))
+    print ('      -o --output        Write results to this file (JSON)')
+
+if __name__=='__main__':
+    target  = TARGET
+    repeats = REPEATS
+    output  = 'startup-benchmark.json'
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:],'ht:r:o:',['help','target=','repeats=','output='])
+    except getopt.GetoptError as e:
+        print (e)
+        help()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ['-h','--help']:
+            help()
+            sys.exit()
+        elif opt in ['-t','--target']:
+            target = float(arg)
+        elif opt in ['-r','--repeats']:
+            repeats = int(arg)
+        elif opt in ['-o','--output']:
+            output = arg
+
+    results = dict(benchmark(target=target,repeats=repeats),
+                   timestamp = time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   python    = platform.python_version(),
+                   machine   = platform.platform())
+    with open(output,'w') as out:
+        json.dump(results,out,indent=2)
+
+    if not all(case['passed'] for case in results['cases']):
+        sys.exit(1)